@@ -1,13 +1,51 @@
+import time
+# Début du chargement du module (profilage du démarrage, voir STARTUP_PROFILE)
+STARTUP_T0 = time.perf_counter()
+
 import os
 import sys
 import re
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+import importlib
+import json
+from flask import Flask, Response, render_template, request, redirect, url_for, session, flash, jsonify
 import sqlite3
 import hashlib
-import yfinance as yf
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta
 import threading
+import warnings
+import random
+import concurrent.futures
+
+# --- PROFILAGE DU DÉMARRAGE ---
+# Avec auto_stop_machines sur Fly.io, la première requête après une mise en veille
+# paie tout le chargement du module. STARTUP_PROFILE=1 affiche le détail
+# (imports, init_db, chargement total, première réponse) ; pour le détail
+# module par module : python -X importtime -c "import app".
+STARTUP_PROFILE = os.environ.get('STARTUP_PROFILE') == '1'
+# Objectif de temps jusqu'à la première réponse sur la VM 1 Go shared-cpu
+STARTUP_TARGET_MS = int(os.environ.get('STARTUP_TARGET_MS', '1500'))
+STARTUP_TIMINGS = {'imports_ms': round((time.perf_counter() - STARTUP_T0) * 1000, 1)}
+
+def lazy_import(module_name):
+    """Importe un module lourd optionnel à sa première utilisation (numpy...).
+
+    Le coût d'import est noté dans STARTUP_TIMINGS['lazy_imports'] ; retourne
+    None si le module n'est pas installé.
+    """
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    start = time.perf_counter()
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as e:
+        print(f"DEBUG import: Module optionnel {module_name} indisponible ({e})")
+        return None
+    elapsed = round((time.perf_counter() - start) * 1000, 1)
+    STARTUP_TIMINGS.setdefault('lazy_imports', {})[module_name] = elapsed
+    print(f"DEBUG import: {module_name} chargé à la demande en {elapsed} ms")
+    return module
 
 app = Flask(__name__)
 app.secret_key = 'monpecule_secret_key_2026_change_this_in_production'
@@ -15,6 +53,8 @@ app.secret_key = 'monpecule_secret_key_2026_change_this_in_production'
 # Token pour les appels CRON (peut être défini via variable d'environnement)
 CRON_TOKEN = os.environ.get('CRON_TOKEN', 'monpecule_cron_2026_change_this')
 EODHD_API_KEY = os.environ.get('EODHD_API_KEY', '6980ce5e766dd6.91379679')
+# Racine de l'API EODHD (surchargeable pour pointer vers un serveur de test local)
+EODHD_API_URL = os.environ.get('EODHD_API_URL', 'https://eodhd.com/api').rstrip('/')
 
 # Redirection www vers domaine principal
 @app.before_request
@@ -23,13 +63,29 @@ def redirect_www():
     if request.host.startswith('www.'):
         return redirect(request.url.replace('www.', '', 1), code=301)
 
-# Taux de change (EUR comme base)
+# Taux de change (EUR comme base) : valeurs par défaut tant que la table fx_rates est vide
 EXCHANGE_RATES = {
     'EUR': 1.0,
     'USD': 1.08,  # 1 EUR = 1.08 USD
     'GBP': 0.86   # 1 EUR = 0.86 GBP
 }
 
+class FxSnapshot:
+    """Taux du jour figés (unités de devise pour 1 EUR) ; remplacé d'un bloc, jamais modifié"""
+
+    def __init__(self, day, rates, stale=()):
+        self.day = day
+        self.rates = {**EXCHANGE_RATES, **rates}
+        # Devises dont le taux du jour est reconduit de la veille
+        self.stale = frozenset(stale)
+
+    def to_eur_factor(self, currency):
+        """Facteur multiplicatif devise -> EUR"""
+        return 1.0 / self.rates.get(currency or 'EUR', 1.0)
+
+# Instantané courant : rechargé une fois par jour depuis fx_rates (voir get_fx_snapshot)
+fx_snapshot = FxSnapshot(None, {})
+
 CURRENCY_SYMBOLS = {
     'EUR': '€',
     'USD': '$',
@@ -51,9 +107,10 @@ def convert_currency(amount, from_currency='EUR', to_currency='EUR'):
     """Convertit un montant d'une devise à une autre"""
     if from_currency == to_currency:
         return amount
+    rates = get_fx_snapshot().rates
     # Convertir d'abord en EUR (base), puis vers la devise cible
-    amount_in_eur = amount / EXCHANGE_RATES.get(from_currency, 1.0)
-    return amount_in_eur * EXCHANGE_RATES.get(to_currency, 1.0)
+    amount_in_eur = amount / rates.get(from_currency, 1.0)
+    return amount_in_eur * rates.get(to_currency, 1.0)
 
 # Filtre personnalisé pour formater les dates
 @app.template_filter('format_date')
@@ -76,8 +133,11 @@ def convert_filter(amount, to_currency='EUR'):
 # --- CONFIGURATION (Chemin absolu indispensable pour cPanel) ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Utiliser le volume Fly.io si disponible, sinon local
-if os.path.exists('/data'):
+# Base explicite (MONPECULE_DB_PATH, prioritaire : tests), sinon volume Fly.io si disponible, sinon local
+if os.environ.get('MONPECULE_DB_PATH'):
+    DB_PATH = os.environ['MONPECULE_DB_PATH']
+    print(f"💾 Utilisation base: {DB_PATH}")
+elif os.path.exists('/data'):
     DB_PATH = '/data/monpecule.db'
     print(f"💾 Utilisation du volume Fly.io: {DB_PATH}")
 else:
@@ -102,133 +162,429 @@ def safe_int(value, default=0):
 def hash_password(password):
     return hashlib.sha256(str.encode(password)).hexdigest()
 
+# --- CONNEXIONS SQLITE ---
+# Une connexion par thread (et par processus), réutilisée d'un appel à l'autre,
+# en mode WAL : les lecteurs (/dashboard, /conseil-du-jour) ne bloquent plus
+# derrière les écritures des tâches de fond, et inversement.
+DB_BUSY_TIMEOUT = safe_float(os.environ.get('DB_BUSY_TIMEOUT'), 15)
+DB_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',   # sûr en WAL, évite un fsync par commit
+    'PRAGMA cache_size = -16000',    # ~16 Mo de cache de pages
+    'PRAGMA mmap_size = 134217728',  # 128 Mo lus via mmap
+    'PRAGMA temp_store = MEMORY',
+)
+db_local = threading.local()
+
+class PooledConnection(sqlite3.Connection):
+    """Connexion partagée par les appels d'un même thread.
+
+    close() ne ferme pas la connexion : quand le dernier utilisateur la rend,
+    une éventuelle transaction non validée est annulée (comme l'aurait fait
+    une vraie fermeture).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.users = 0
+
+    def close(self):
+        self.users = max(0, self.users - 1)
+        if self.users == 0 and self.in_transaction:
+            self.rollback()
+
+    def release(self):
+        """Remet la connexion à zéro (fin de requête), quoi qu'aient oublié les appelants"""
+        self.users = 0
+        if self.in_transaction:
+            self.rollback()
+
 def get_connection():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    conn = getattr(db_local, 'conn', None)
+    if conn is None or db_local.pid != os.getpid():
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                               factory=PooledConnection)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        db_local.conn = conn
+        db_local.pid = os.getpid()
+    conn.users += 1
     return conn
 
+@app.teardown_request
+def release_connection(exc):
+    """Libère la connexion du thread à la fin de chaque requête"""
+    conn = getattr(db_local, 'conn', None)
+    if conn is not None and db_local.pid == os.getpid():
+        conn.release()
+
+def open_staging(conn, table, keep_where=None, params=()):
+    """Prépare la table temporaire de staging de `table` et renvoie son nom qualifié.
+
+    Elle est vidée, puis pré-remplie avec les lignes actuelles vérifiant
+    `keep_where` ; son remplissage ne prend pas le verrou d'écriture de la base.
+    """
+    staging = f'temp.{table}_staging'
+    conn.execute(f'CREATE TEMP TABLE IF NOT EXISTS {table}_staging AS SELECT * FROM main.{table} WHERE 0')
+    conn.execute(f'DELETE FROM {staging}')
+    if keep_where:
+        conn.execute(f'INSERT INTO {staging} SELECT * FROM main.{table} WHERE {keep_where}', params)
+    return staging
+
+def publish_staged(conn, table):
+    """Remplace le contenu de `table` par sa table de staging en une transaction courte.
+
+    Les lecteurs voient l'ancien ou le nouvel instantané complet, jamais un état partiel.
+    """
+    conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(f'DELETE FROM main.{table}')
+        count = conn.execute(f'INSERT INTO main.{table} SELECT * FROM temp.{table}_staging').rowcount
+        bump_data_version(conn, table)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    conn.execute(f'DELETE FROM temp.{table}_staging')
+    conn.commit()
+    return count
+
+def bump_data_version(conn, *scopes):
+    """Incrémente la version des scopes donnés (dans la transaction de l'appelant)"""
+    conn.executemany('''INSERT INTO data_versions (scope, version, updated_at) 
+                        VALUES (?, 1, strftime('%Y-%m-%d %H:%M:%S', 'now')) 
+                        ON CONFLICT(scope) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at''',
+                     [(scope,) for scope in scopes])
+
+# --- SCHÉMA ET MIGRATIONS ---
+# Chaque migration est appliquée une seule fois ; la version courante est
+# stockée dans PRAGMA user_version. Au démarrage, si la base est à jour,
+# init_db ne fait qu'une lecture de cette version.
+def add_column_if_missing(c, table, column, definition):
+    """ALTER TABLE ADD COLUMN seulement si la colonne n'existe pas encore"""
+    columns = [row[1] for row in c.execute(f'PRAGMA table_info({table})').fetchall()]
+    if column in columns:
+        return False
+    c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    print(f"Migration: Colonne {column} ajoutee a {table}")
+    return True
+
+def migration_1_schema_initial(c):
+    """Tables d'origine et colonnes ajoutées au fil des versions"""
+    c.execute('''CREATE TABLE IF NOT EXISTS users 
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, nom TEXT, prenom TEXT, 
+                 email TEXT UNIQUE, tel TEXT, password TEXT, derniere_maj TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS comptes 
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, nom_compte TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS actifs 
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, compte_id INTEGER, nom_actif TEXT, 
+                 ticker_isin TEXT, prix_achat REAL, quantite INTEGER, frais REAL, 
+                 prix_actuel REAL, prix_veille REAL, date_achat TEXT, devise_cotation TEXT DEFAULT 'EUR')''')
+    
+    # Table historique des prix
+    c.execute('''CREATE TABLE IF NOT EXISTS historique_prix 
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, 
+                  actif_id INTEGER, 
+                  date TEXT, 
+                  prix REAL, 
+                  devise TEXT,
+                  FOREIGN KEY (actif_id) REFERENCES actifs(id) ON DELETE CASCADE)''')
+    
+    # Table cumul PV mensuelle (cumul des variations journalières)
+    c.execute('''CREATE TABLE IF NOT EXISTS cumul_pv_mois 
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, 
+                  actif_id INTEGER, 
+                  mois TEXT, 
+                  cumul_pv REAL DEFAULT 0,
+                  derniere_mise_a_jour TEXT,
+                  UNIQUE(actif_id, mois),
+                  FOREIGN KEY (actif_id) REFERENCES actifs(id) ON DELETE CASCADE)''')
+    
+    add_column_if_missing(c, 'users', 'derniere_maj', 'TEXT')
+    add_column_if_missing(c, 'actifs', 'prix_veille', 'REAL DEFAULT 0')
+    add_column_if_missing(c, 'actifs', 'date_achat', 'TEXT')
+    add_column_if_missing(c, 'users', 'devise', "TEXT DEFAULT 'EUR'")
+    add_column_if_missing(c, 'actifs', 'devise_cotation', "TEXT DEFAULT 'EUR'")
+    if add_column_if_missing(c, 'actifs', 'prix_debut_mois', 'REAL'):
+        # Initialiser avec le prix actuel pour les actifs existants
+        c.execute("UPDATE actifs SET prix_debut_mois = prix_actuel WHERE prix_debut_mois IS NULL")
+    
+    # Table market_analysis (cache pour les conseils)
+    c.execute('''CREATE TABLE IF NOT EXISTS market_analysis 
+                 (ticker TEXT PRIMARY KEY, 
+                  name TEXT, 
+                  score REAL, 
+                  nb_news INTEGER, 
+                  signal TEXT, 
+                  signal_class TEXT, 
+                  price REAL, 
+                  last_updated TEXT)''')
+    
+    # Table etf_analysis (cache pour les conseils ETF)
+    c.execute('''CREATE TABLE IF NOT EXISTS etf_analysis 
+                 (ticker TEXT PRIMARY KEY, 
+                  name TEXT, 
+                  score REAL, 
+                  nb_news INTEGER, 
+                  signal TEXT, 
+                  signal_class TEXT, 
+                  price REAL, 
+                  last_updated TEXT,
+                  expense_ratio TEXT,
+                  category TEXT,
+                  day_change_pct REAL,
+                  trend_15d_pct REAL)''')
+    add_column_if_missing(c, 'etf_analysis', 'expense_ratio', 'TEXT')
+    add_column_if_missing(c, 'etf_analysis', 'category', 'TEXT')
+    add_column_if_missing(c, 'etf_analysis', 'day_change_pct', 'REAL')
+    add_column_if_missing(c, 'etf_analysis', 'trend_15d_pct', 'REAL')
+
+def migration_2_resolution_symboles(c):
+    """Cache persistant identifiant -> symbole et cache négatif des échecs"""
+    # Table de résolution identifiant (ISIN, nom, ticker) -> symbole coté
+    c.execute('''CREATE TABLE IF NOT EXISTS symbol_resolution 
+                 (identifier TEXT PRIMARY KEY, 
+                  symbol TEXT NOT NULL, 
+                  name TEXT, 
+                  exchange TEXT, 
+                  resolved_at TEXT)''')
+    
+    # Cache négatif : identifiants introuvables avec backoff exponentiel
+    c.execute('''CREATE TABLE IF NOT EXISTS lookup_failures 
+                 (identifier TEXT PRIMARY KEY, 
+                  failures INTEGER DEFAULT 0, 
+                  first_failure TEXT, 
+                  last_failure TEXT, 
+                  retry_after TEXT)''')
+
+def migration_3_resumes_portefeuille(c):
+    """Résumés de portefeuille matérialisés (mis à jour à chaque écriture)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS portfolio_summary 
+                 (user_id INTEGER PRIMARY KEY, 
+                  mois TEXT, 
+                  total_achat REAL DEFAULT 0, 
+                  total_actuel REAL DEFAULT 0, 
+                  total_pv REAL DEFAULT 0, 
+                  total_day_pv REAL DEFAULT 0, 
+                  total_month_pv REAL DEFAULT 0, 
+                  top_gainer_nom TEXT, 
+                  top_gainer_perf REAL, 
+                  top_loser_nom TEXT, 
+                  top_loser_perf REAL, 
+                  updated_at TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS compte_summary 
+                 (compte_id INTEGER PRIMARY KEY, 
+                  user_id INTEGER, 
+                  achat REAL DEFAULT 0, 
+                  actuel REAL DEFAULT 0, 
+                  pv REAL DEFAULT 0, 
+                  day_pv REAL DEFAULT 0, 
+                  month_pv REAL DEFAULT 0, 
+                  updated_at TEXT)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_compte_summary_user ON compte_summary(user_id)')
+
+def migration_4_historique_unique(c):
+    """Un seul prix par actif et par jour (clé des upserts de update_prices)"""
+    # Supprimer d'éventuels doublons (on garde le dernier relevé du jour)
+    c.execute('''DELETE FROM historique_prix WHERE id NOT IN
+                 (SELECT MAX(id) FROM historique_prix GROUP BY actif_id, date)''')
+    c.execute('DROP INDEX IF EXISTS idx_historique_actif_date')
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_historique_actif_date_unique 
+                 ON historique_prix(actif_id, date)''')
+
+def migration_5_jobs(c):
+    """Historique des tâches de fond (état, progression, durées)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs 
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, 
+                  job_type TEXT, 
+                  job_key TEXT, 
+                  state TEXT, 
+                  created_at TEXT, 
+                  started_at TEXT, 
+                  finished_at TEXT, 
+                  duration_ms REAL, 
+                  processed INTEGER DEFAULT 0, 
+                  total INTEGER DEFAULT 0, 
+                  message TEXT, 
+                  error TEXT)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_type_created ON jobs(job_type, created_at)')
+
+def migration_6_etat_analyse(c):
+    """État par ticker de l'analyse de sentiment (analyse incrémentale)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS analysis_state 
+                 (ticker TEXT PRIMARY KEY, 
+                  last_news_at TEXT, 
+                  last_run_at TEXT, 
+                  last_scored_at TEXT)''')
+
+def migration_7_news(c):
+    """Stockage local des news (dédupliquées par lien) pour le calcul du sentiment"""
+    c.execute('''CREATE TABLE IF NOT EXISTS news_items 
+                 (ticker TEXT NOT NULL, 
+                  link_hash TEXT NOT NULL, 
+                  published_at TEXT NOT NULL, 
+                  polarity REAL, 
+                  title TEXT, 
+                  PRIMARY KEY (ticker, link_hash))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_news_ticker_date ON news_items(ticker, published_at)')
+
+def migration_8_bougies_eod(c):
+    """Historique journalier OHLCV local (récupération incrémentale EODHD)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS eod_candles 
+                 (symbol TEXT NOT NULL, 
+                  date TEXT NOT NULL, 
+                  open REAL, 
+                  high REAL, 
+                  low REAL, 
+                  close REAL NOT NULL, 
+                  adjusted_close REAL, 
+                  volume REAL, 
+                  PRIMARY KEY (symbol, date)) WITHOUT ROWID''')
+
+def migration_9_indicateurs_etf(c):
+    """Indicateurs techniques calculés par le moteur vectorisé"""
+    add_column_if_missing(c, 'etf_analysis', 'sma_20', 'REAL')
+    add_column_if_missing(c, 'etf_analysis', 'sma_50', 'REAL')
+    add_column_if_missing(c, 'etf_analysis', 'volatility_pct', 'REAL')
+    add_column_if_missing(c, 'etf_analysis', 'max_drawdown_pct', 'REAL')
+    add_column_if_missing(c, 'etf_analysis', 'momentum_pct', 'REAL')
+
+def migration_10_quotas_fournisseurs(c):
+    """Compteur journalier d'appels par fournisseur (quota partagé de la clé API)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS provider_usage 
+                 (provider TEXT NOT NULL, 
+                  day TEXT NOT NULL, 
+                  calls INTEGER NOT NULL DEFAULT 0, 
+                  PRIMARY KEY (provider, day))''')
+
+def migration_11_versions_donnees(c):
+    """Versions de données par actif / utilisateur / table d'analyse (validateurs ETag, Last-Modified).
+
+    Des triggers incrémentent la version de l'actif et de son propriétaire à chaque
+    écriture dans historique_prix ou actifs, quel que soit le chemin d'écriture.
+    """
+    c.execute('''CREATE TABLE IF NOT EXISTS data_versions 
+                 (scope TEXT PRIMARY KEY, 
+                  version INTEGER NOT NULL DEFAULT 0, 
+                  updated_at TEXT NOT NULL)''')
+    bump = '''INSERT INTO data_versions (scope, version, updated_at) 
+              SELECT {scope}, 1, strftime('%Y-%m-%d %H:%M:%S', 'now') {source} 
+              ON CONFLICT(scope) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at;'''
+    for table, actif_col, compte_col in (('historique_prix', 'actif_id', None), ('actifs', 'id', 'compte_id')):
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            if compte_col:
+                owner = bump.format(scope="'user:' || user_id", source=f"FROM comptes WHERE id = {row}.{compte_col}")
+            else:
+                owner = bump.format(scope="'user:' || c.user_id",
+                                    source=f"FROM actifs a JOIN comptes c ON c.id = a.compte_id WHERE a.id = {row}.{actif_col}")
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_version_{table}_{event.lower()} 
+                          AFTER {event} ON {table} BEGIN 
+                          {bump.format(scope=f"'actif:' || {row}.{actif_col}", source='WHERE 1')} 
+                          {owner} 
+                          END''')
+
+def migration_12_historique_portefeuille(c):
+    """Valorisation quotidienne matérialisée par compte (historique du portefeuille)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS portfolio_history 
+                 (user_id INTEGER NOT NULL, 
+                  compte_id INTEGER NOT NULL, 
+                  date TEXT NOT NULL, 
+                  valeur REAL NOT NULL, 
+                  PRIMARY KEY (user_id, date, compte_id)) WITHOUT ROWID''')
+    # Empreinte des positions utilisées : si elles changent, l'historique est reconstruit
+    c.execute('''CREATE TABLE IF NOT EXISTS portfolio_history_state 
+                 (user_id INTEGER PRIMARY KEY, 
+                  positions_hash TEXT, 
+                  last_date TEXT, 
+                  updated_at TEXT)''')
+
+def migration_13_archive_mensuelle(c):
+    """Totaux de PV des mois clôturés, par utilisateur et par compte"""
+    c.execute('''CREATE TABLE IF NOT EXISTS monthly_pv_archive 
+                 (user_id INTEGER NOT NULL, 
+                  compte_id INTEGER NOT NULL, 
+                  mois TEXT NOT NULL, 
+                  cumul_pv REAL NOT NULL, 
+                  nb_actifs INTEGER NOT NULL, 
+                  closed_at TEXT NOT NULL, 
+                  PRIMARY KEY (user_id, compte_id, mois))''')
+
+def migration_14_taux_de_change(c):
+    """Taux de change quotidiens (unités de devise pour 1 EUR), historique conservé"""
+    c.execute('''CREATE TABLE IF NOT EXISTS fx_rates 
+                 (devise TEXT NOT NULL, 
+                  date TEXT NOT NULL, 
+                  rate REAL NOT NULL, 
+                  PRIMARY KEY (devise, date)) WITHOUT ROWID''')
+
+def migration_15_etat_bougies(c):
+    """Profondeur d'historique EOD déjà demandée par symbole (fin du premier remplissage)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS eod_candles_state 
+                 (symbol TEXT PRIMARY KEY, 
+                  bootstrap_from TEXT NOT NULL)''')
+
+def migration_16_taux_provisoires(c):
+    """Taux du jour reconduits de la veille faute de cotation (remplacés au passage suivant)"""
+    add_column_if_missing(c, 'fx_rates', 'stale', 'INTEGER NOT NULL DEFAULT 0')
+
+# Liste ordonnée (version, migration) : ne jamais modifier une migration déjà déployée,
+# en ajouter une nouvelle à la fin
+MIGRATIONS = [
+    (1, migration_1_schema_initial),
+    (2, migration_2_resolution_symboles),
+    (3, migration_3_resumes_portefeuille),
+    (4, migration_4_historique_unique),
+    (5, migration_5_jobs),
+    (6, migration_6_etat_analyse),
+    (7, migration_7_news),
+    (8, migration_8_bougies_eod),
+    (9, migration_9_indicateurs_etf),
+    (10, migration_10_quotas_fournisseurs),
+    (11, migration_11_versions_donnees),
+    (12, migration_12_historique_portefeuille),
+    (13, migration_13_archive_mensuelle),
+    (14, migration_14_taux_de_change),
+    (15, migration_15_etat_bougies),
+    (16, migration_16_taux_provisoires),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+migration_lock = threading.Lock()
+
 def init_db():
     try:
         conn = get_connection()
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS users 
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT, nom TEXT, prenom TEXT, 
-                     email TEXT UNIQUE, tel TEXT, password TEXT, derniere_maj TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS comptes 
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, nom_compte TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS actifs 
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT, compte_id INTEGER, nom_actif TEXT, 
-                     ticker_isin TEXT, prix_achat REAL, quantite INTEGER, frais REAL, 
-                     prix_actuel REAL, prix_veille REAL, date_achat TEXT, devise_cotation TEXT DEFAULT 'EUR')''')
-        
-        # Table historique des prix
-        c.execute('''CREATE TABLE IF NOT EXISTS historique_prix 
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                      actif_id INTEGER, 
-                      date TEXT, 
-                      prix REAL, 
-                      devise TEXT,
-                      FOREIGN KEY (actif_id) REFERENCES actifs(id) ON DELETE CASCADE)''')
-        
-        # Index pour accélérer les requêtes historiques
-        c.execute('''CREATE INDEX IF NOT EXISTS idx_historique_actif_date 
-                     ON historique_prix(actif_id, date)''')
-        
-        # Table cumul PV mensuelle (cumul des variations journalières)
-        c.execute('''CREATE TABLE IF NOT EXISTS cumul_pv_mois 
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                      actif_id INTEGER, 
-                      mois TEXT, 
-                      cumul_pv REAL DEFAULT 0,
-                      derniere_mise_a_jour TEXT,
-                      UNIQUE(actif_id, mois),
-                      FOREIGN KEY (actif_id) REFERENCES actifs(id) ON DELETE CASCADE)''')
-        
-        # Migration : ajouter derniere_maj si elle n'existe pas
-        try:
-            c.execute("ALTER TABLE users ADD COLUMN derniere_maj TEXT")
-            print("Migration: Colonne derniere_maj ajoutee a users")
-        except:
-            pass  # Colonne deja presente
-        
-        # Migration : ajouter prix_veille si elle n'existe pas
-        try:
-            c.execute("ALTER TABLE actifs ADD COLUMN prix_veille REAL DEFAULT 0")
-            print("Migration: Colonne prix_veille ajoutee a actifs")
-        except:
-            pass  # Colonne deja presente
-        
-        # Migration : ajouter date_achat si elle n'existe pas
-        try:
-            c.execute("ALTER TABLE actifs ADD COLUMN date_achat TEXT")
-            print("Migration: Colonne date_achat ajoutee a actifs")
-        except:
-            pass  # Colonne deja presente
-        
-        # Migration : ajouter devise si elle n'existe pas
-        try:
-            c.execute("ALTER TABLE users ADD COLUMN devise TEXT DEFAULT 'EUR'")
-            print("Migration: Colonne devise ajoutee a users")
-        except:
-            pass  # Colonne deja presente
-        
-        # Migration : ajouter devise_cotation aux actifs
-        try:
-            c.execute("ALTER TABLE actifs ADD COLUMN devise_cotation TEXT DEFAULT 'EUR'")
-            print("Migration: Colonne devise_cotation ajoutee a actifs")
-        except:
-            pass  # Colonne deja presente
-        
-        # Migration : ajouter prix_debut_mois aux actifs
-        try:
-            c.execute("ALTER TABLE actifs ADD COLUMN prix_debut_mois REAL")
-            # Initialiser avec le prix actuel pour les actifs existants
-            c.execute("UPDATE actifs SET prix_debut_mois = prix_actuel WHERE prix_debut_mois IS NULL")
-            print("Migration: Colonne prix_debut_mois ajoutee a actifs")
-        except:
-            pass  # Colonne deja presente
-        
-        # Table market_analysis (cache pour les conseils)
-        c.execute('''CREATE TABLE IF NOT EXISTS market_analysis 
-                     (ticker TEXT PRIMARY KEY, 
-                      name TEXT, 
-                      score REAL, 
-                      nb_news INTEGER, 
-                      signal TEXT, 
-                      signal_class TEXT, 
-                      price REAL, 
-                      last_updated TEXT)''')
-        
-        # Table etf_analysis (cache pour les conseils ETF)
-        c.execute('''CREATE TABLE IF NOT EXISTS etf_analysis 
-                     (ticker TEXT PRIMARY KEY, 
-                      name TEXT, 
-                      score REAL, 
-                      nb_news INTEGER, 
-                      signal TEXT, 
-                      signal_class TEXT, 
-                      price REAL, 
-                      last_updated TEXT,
-                      expense_ratio TEXT,
-                      category TEXT,
-                      day_change_pct REAL,
-                      trend_15d_pct REAL)''')
+        # Chemin rapide : schéma déjà à jour, aucun travail
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            conn.close()
+            return
         
-        # Migration: ajouter colonnes si manquantes
-        try:
-            c.execute("ALTER TABLE etf_analysis ADD COLUMN expense_ratio TEXT")
-            c.execute("ALTER TABLE etf_analysis ADD COLUMN category TEXT")
-            c.execute("ALTER TABLE etf_analysis ADD COLUMN day_change_pct REAL")
-            c.execute("ALTER TABLE etf_analysis ADD COLUMN trend_15d_pct REAL")
-        except: pass
-            
-        conn.commit()
+        # Verrou du processus + verrou d'écriture SQLite (BEGIN IMMEDIATE) : un seul
+        # worker gunicorn applique les migrations, les autres attendent puis relisent la version
+        with migration_lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                c = conn.cursor()
+                for target, migration in MIGRATIONS:
+                    if target <= version:
+                        continue
+                    migration(c)
+                    c.execute(f'PRAGMA user_version = {target}')
+                    print(f"Migration: Schema v{target} applique ({migration.__name__})")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
         conn.close()
     except Exception as e:
         print(f"Erreur init_db: {e}")
 
 # Initialisation au démarrage
+init_db_start = time.perf_counter()
 init_db()
+STARTUP_TIMINGS['init_db_ms'] = round((time.perf_counter() - init_db_start) * 1000, 1)
 
 # --- CONSTANTES ---
 # Liste des tickers du SBF 120 + CAC Mid 60 + CAC Small (Approx 250 valeurs)
@@ -404,18 +760,340 @@ def normalize_forced_symbol(identifier):
     return identifier
 
 # --- API YAHOO FINANCE (yfinance) ---
-def fetch_price_from_api(identifier):
-    if not identifier: return None, None, None, None
-    identifier = normalize_forced_symbol(identifier.strip())
-    print(f"DEBUG fetch: Recherche pour '{identifier}'")
-    
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Referer': 'https://finance.yahoo.com/'
-    }
+YAHOO_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Referer': 'https://finance.yahoo.com/'
+}
+
+# --- CLIENT HTTP FOURNISSEURS (EODHD / Yahoo) ---
+# Sessions keep-alive partagées, limites de débit, retries avec jitter et
+# disjoncteur par fournisseur : quand un fournisseur est dégradé on échoue
+# immédiatement au lieu d'empiler des timeouts dans tous les threads.
+class CircuitOpenError(Exception):
+    """Le disjoncteur du fournisseur est ouvert : appel refusé sans réseau"""
+
+class QuotaExceededError(CircuitOpenError):
+    """Budget journalier du fournisseur épuisé pour cette priorité : appel refusé sans réseau"""
+
+# Priorités d'appel : quand le quota baisse, l'analyse est coupée d'abord, puis le cron,
+# les cotations demandées par un utilisateur passent jusqu'au bout.
+# Part du quota journal qui doit rester disponible après l'appel, par priorité :
+QUOTA_RESERVES = {
+    'user': 0.0,
+    'cron': safe_float(os.environ.get('QUOTA_RESERVE_CRON'), 0.10),
+    'analysis': safe_float(os.environ.get('QUOTA_RESERVE_ANALYSIS'), 0.30),
+}
+call_context = threading.local()
+
+def current_priority():
+    """Priorité des appels fournisseurs du thread courant ('user' par défaut : requête web)"""
+    return getattr(call_context, 'priority', 'user')
+
+def with_priority(fn, priority=None):
+    """Enveloppe `fn` pour l'exécuter avec la priorité donnée (par défaut celle du thread appelant).
 
+    Nécessaire pour les ThreadPoolExecutor : les threads ouvriers n'héritent pas du contexte.
+    """
+    priority = priority or current_priority()
+
+    def wrapper(*args, **kwargs):
+        previous = getattr(call_context, 'priority', None)
+        call_context.priority = priority
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            call_context.priority = previous
+    return wrapper
+
+class TokenBucket:
+    """Seau à jetons : `rate` appels par seconde en régime établi, rafales limitées à `burst`"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = max(1.0, burst if burst else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Le jeton est pris tout de suite (éventuellement à découvert) : les threads
+            # suivants attendent derrière, dans l'ordre d'arrivée
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay:
+            time.sleep(delay)
+
+class QuotaLedger:
+    """Compteur journalier (UTC) des appels d'un fournisseur, persisté dans provider_usage.
+
+    Les appels sont comptés en mémoire et écrits par paquets (additivement, sur une
+    connexion dédiée) pour ne pas ajouter une écriture SQLite par requête HTTP.
+    """
+
+    def __init__(self, provider, daily_quota, flush_every=20, flush_interval=30):
+        self.provider = provider
+        self.daily_quota = daily_quota
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.conn = None
+        self.conn_pid = None
+        self.day = None
+        self.persisted = 0
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def _db(self):
+        if self.conn is None or self.conn_pid != os.getpid():
+            self.conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+            self.conn_pid = os.getpid()
+        return self.conn
+
+    def _flush(self):
+        if self.pending:
+            db = self._db()
+            db.execute('''INSERT INTO provider_usage (provider, day, calls) VALUES (?, ?, ?)
+                          ON CONFLICT(provider, day) DO UPDATE SET calls = calls + excluded.calls''',
+                       (self.provider, self.day, self.pending))
+            db.commit()
+            self.pending = 0
+        # Relire le total : intègre les appels des autres processus
+        row = self._db().execute('SELECT calls FROM provider_usage WHERE provider = ? AND day = ?',
+                                 (self.provider, self.day)).fetchone()
+        self.persisted = row[0] if row else 0
+        self.last_flush = time.monotonic()
+
+    def _safe_flush(self):
+        """_flush sans lever : une base verrouillée ne doit pas faire échouer l'appel fournisseur"""
+        try:
+            self._flush()
+        except sqlite3.Error as e:
+            print(f"DEBUG quota: Erreur écriture compteur {self.provider} = {e}")
+
+    def _roll(self):
+        day = datetime.utcnow().strftime('%Y-%m-%d')
+        if day != self.day:
+            if self.day is not None:
+                self._safe_flush()
+            self.day, self.pending = day, 0
+            self._safe_flush()
+
+    def limit_for(self, priority):
+        """Nombre d'appels du jour au-delà duquel cette priorité est refusée (None : illimité)"""
+        if not self.daily_quota:
+            return None
+        return int(self.daily_quota * (1 - QUOTA_RESERVES.get(priority, 0.0)))
+
+    def allows(self, cost=1, priority=None):
+        """Vrai si `cost` appels tiennent encore dans le budget de la priorité"""
+        limit = self.limit_for(priority or current_priority())
+        with self.lock:
+            self._roll()
+            return limit is None or self.persisted + self.pending + cost <= limit
+
+    def reserve(self, cost=1, priority=None):
+        """Décompte `cost` appels, ou lève QuotaExceededError si le budget de la priorité est épuisé"""
+        priority = priority or current_priority()
+        limit = self.limit_for(priority)
+        with self.lock:
+            self._roll()
+            used = self.persisted + self.pending
+            if limit is not None and used + cost > limit:
+                raise QuotaExceededError(f"{self.provider}: quota du jour atteint pour la priorité "
+                                         f"{priority} ({used}/{self.daily_quota})")
+            self.pending += cost
+            if self.pending >= self.flush_every or time.monotonic() - self.last_flush > self.flush_interval:
+                self._safe_flush()
+
+    def flush(self):
+        with self.lock:
+            if self.day is not None:
+                self._safe_flush()
+
+    def status(self):
+        with self.lock:
+            self._roll()
+            used = self.persisted + self.pending
+        return {'day': self.day, 'calls': used, 'daily_quota': self.daily_quota or None,
+                'limits': {p: self.limit_for(p) for p in QUOTA_RESERVES}}
+
+class ProviderClient:
+    """Client HTTP d'un fournisseur de données (session poolée + retries + disjoncteur)"""
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, name, rate, timeout, headers=None, max_retries=2,
+                 failure_threshold=5, cooldown=30, pool_size=20, burst=None, daily_quota=0):
+        self.name = name
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.limiter = TokenBucket(rate, burst)
+        self.ledger = QuotaLedger(name, daily_quota)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_thread = None  # Thread de l'appel d'essai en cours (état demi-ouvert)
+
+    def is_open(self):
+        """Vrai si le disjoncteur refuse l'appel.
+
+        Après `cooldown` s (demi-ouvert), un seul appel d'essai passe : les autres
+        threads restent refusés jusqu'à record_success / record_failure.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if time.monotonic() - self.opened_at < self.cooldown or self.probe_thread is not None:
+                return True
+            self.probe_thread = threading.get_ident()
+            return False
+
+    def release_probe(self):
+        """Libère l'appel d'essai du thread courant s'il s'est terminé sans verdict (quota...)"""
+        with self.lock:
+            if self.probe_thread == threading.get_ident():
+                self.probe_thread = None
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.probe_thread = None
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.probe_thread = None
+            if self.consecutive_failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"DEBUG http: Disjoncteur {self.name} ouvert ({self.consecutive_failures} échecs)")
+                self.opened_at = time.monotonic()
+
+    def get(self, url, params=None, timeout=None, cost=1):
+        """GET avec retries (backoff exponentiel + jitter) sur erreurs réseau, 429 et 5xx.
+
+        `cost` : nombre d'appels décomptés du quota du fournisseur par requête.
+        Retourne la dernière réponse obtenue (l'appelant teste status_code comme
+        avec requests.get) ou lève l'exception réseau / CircuitOpenError
+        (QuotaExceededError si le budget de la priorité courante est épuisé).
+        """
+        if self.is_open():
+            raise CircuitOpenError(f"{self.name} indisponible (disjoncteur ouvert)")
+
+        response, error = None, None
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.ledger.reserve(cost)
+                self.limiter.wait()
+            except Exception:
+                self.release_probe()
+                raise
+            try:
+                response = self.session.get(url, params=params, timeout=timeout or self.timeout)
+                error = None
+                if response.status_code not in self.RETRY_STATUSES:
+                    self.record_success()
+                    return response
+            except requests.RequestException as e:
+                response, error = None, e
+            if attempt < self.max_retries:
+                time.sleep(0.25 * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+        self.record_failure()
+        if error is not None:
+            raise error
+        return response
+
+    def status(self):
+        """État du disjoncteur et consommation du jour (diagnostic)"""
+        with self.lock:
+            state = {'provider': self.name, 'consecutive_failures': self.consecutive_failures,
+                     'open': self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown}
+        state['quota'] = self.ledger.status()
+        return state
+
+# Timeouts (connexion, lecture), débit et quota journalier centralisés par fournisseur
+# (EODHD_DAILY_QUOTA : appels/jour de l'abonnement, 0 = non suivi)
+EODHD = ProviderClient('eodhd', rate=safe_float(os.environ.get('EODHD_MAX_RPS'), 10),
+                       timeout=(3.05, safe_float(os.environ.get('EODHD_TIMEOUT'), 6)),
+                       burst=safe_float(os.environ.get('EODHD_BURST'), 20),
+                       daily_quota=safe_int(os.environ.get('EODHD_DAILY_QUOTA'), 100000))
+YAHOO = ProviderClient('yahoo', rate=safe_float(os.environ.get('YAHOO_MAX_RPS'), 4),
+                       timeout=(3.05, safe_float(os.environ.get('YAHOO_TIMEOUT'), 8)),
+                       headers=YAHOO_HEADERS, burst=safe_float(os.environ.get('YAHOO_BURST'), 4),
+                       daily_quota=safe_int(os.environ.get('YAHOO_DAILY_QUOTA'), 0))
+PROVIDERS = {'eodhd': EODHD, 'yahoo': YAHOO}
+
+# Coût EODHD d'une requête par endpoint (en appels décomptés du quota)
+EODHD_COST_NEWS = 5
+EODHD_COST_BULK = 100
+
+# Durée de validité d'une résolution identifiant -> symbole avant revalidation
+SYMBOL_RESOLUTION_TTL = timedelta(days=safe_int(os.environ.get('SYMBOL_RESOLUTION_TTL_DAYS'), 7))
+
+def get_cached_resolution(identifier, max_age=SYMBOL_RESOLUTION_TTL):
+    """Lit la résolution persistée d'un identifiant (None si absente ou expirée)"""
+    if not identifier:
+        return None
+    try:
+        conn = get_connection()
+        row = conn.execute('SELECT symbol, name, exchange, resolved_at FROM symbol_resolution WHERE identifier = ?',
+                           (identifier.upper().strip(),)).fetchone()
+        conn.close()
+    except Exception as e:
+        print(f"DEBUG resolution: Erreur lecture cache = {e}")
+        return None
+    if not row:
+        return None
+    if max_age is not None:
+        try:
+            resolved_at = datetime.strptime(row['resolved_at'], '%Y-%m-%d %H:%M:%S')
+        except (ValueError, TypeError):
+            return None
+        if datetime.now() - resolved_at > max_age:
+            return None
+    return row
+
+def save_resolution(identifier, symbol, name, exchange=None):
+    """Persiste (ou rafraîchit) la résolution identifiant -> symbole"""
+    try:
+        conn = get_connection()
+        conn.execute('''INSERT INTO symbol_resolution (identifier, symbol, name, exchange, resolved_at)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(identifier) DO UPDATE SET
+                            symbol = excluded.symbol, name = excluded.name,
+                            exchange = excluded.exchange, resolved_at = excluded.resolved_at''',
+                     (identifier.upper().strip(), symbol, name, exchange,
+                      datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"DEBUG resolution: Erreur écriture cache = {e}")
+
+def resolve_symbol(identifier):
+    """Résout un identifiant (ticker, ISIN, nom) en symbole coté.
+
+    Après le mapping forcé, lit la table symbol_resolution : les appels Yahoo
+    (validation directe puis recherche) ne sont faits que si la résolution est
+    absente ou plus vieille que SYMBOL_RESOLUTION_TTL. Retourne (symbole, nom).
+    """
     symbol = None
     name = identifier
+    exchange = None
 
     # Priorité 0: mapping forcé pour certains tickers/ISIN ambigus
     ident_upper = identifier.upper()
@@ -429,6 +1107,11 @@ def fetch_price_from_api(identifier):
     if mapped_symbol:
         symbol = mapped_symbol
         print(f"DEBUG fetch: Mapping forcé appliqué -> {symbol}")
+    else:
+        cached = get_cached_resolution(identifier)
+        if cached:
+            print(f"DEBUG fetch: Résolution en cache {identifier} -> {cached['symbol']}")
+            return cached['symbol'], cached['name'] or cached['symbol']
     
     # Strategie 1: Si ca ressemble a un symbole (court, majuscules, avec .PA etc), essayer directement
     if (not symbol) and (len(identifier) <= 6 or '.' in identifier or identifier.isupper()):
@@ -437,14 +1120,16 @@ def fetch_price_from_api(identifier):
         # Verifier si le symbole existe en essayant de recuperer le prix
         try:
             test_url = f"https://query1.finance.yahoo.com/v8/finance/chart/{symbol}?interval=1m&range=1d"
-            res = requests.get(test_url, headers=headers, timeout=5)
+            res = YAHOO.get(test_url)
             if res.status_code == 200:
                 data = res.json()
                 if data.get('chart', {}).get('result'):
                     meta = data['chart']['result'][0].get('meta', {})
                     name = meta.get('longName') or meta.get('shortName') or symbol
+                    exchange = meta.get('exchangeName')
                     print(f"DEBUG fetch: Symbole direct valide = {symbol}, nom = {name}")
                     # On garde ce symbole
+                    save_resolution(identifier, symbol, name, exchange)
                 else:
                     symbol = None  # Pas trouve, on va chercher
             else:
@@ -464,7 +1149,7 @@ def fetch_price_from_api(identifier):
                 search_query = identifier
             
             search_url = f"https://query1.finance.yahoo.com/v1/finance/search?q={search_query}"
-            res = requests.get(search_url, headers=headers, timeout=10)
+            res = YAHOO.get(search_url)
             print(f"DEBUG fetch: Status recherche = {res.status_code} (query={search_query})")
             if res.status_code == 200:
                 data = res.json()
@@ -496,7 +1181,10 @@ def fetch_price_from_api(identifier):
                     best_quote = max(quotes, key=quote_score)
                     symbol = best_quote.get('symbol')
                     name = best_quote.get('longname') or best_quote.get('shortname') or symbol
+                    exchange = best_quote.get('exchange') or best_quote.get('fullExchangeName')
                     print(f"DEBUG fetch: Symbole retenu via recherche = {symbol}")
+                    if symbol:
+                        save_resolution(identifier, symbol, name, exchange)
         except Exception as e:
             print(f"DEBUG fetch: Erreur recherche = {e}")
     
@@ -505,50 +1193,138 @@ def fetch_price_from_api(identifier):
         symbol = identifier.upper()
         print(f"DEBUG fetch: Utilisation du ticker brut = {symbol}")
 
+    return symbol, name
+
+# Backoff exponentiel pour les identifiants introuvables (cache négatif)
+LOOKUP_BACKOFF_BASE = timedelta(minutes=safe_int(os.environ.get('LOOKUP_BACKOFF_BASE_MINUTES'), 60))
+LOOKUP_BACKOFF_MAX = timedelta(days=safe_int(os.environ.get('LOOKUP_BACKOFF_MAX_DAYS'), 7))
+
+def get_lookup_failure(identifier):
+    """Retourne l'état d'échec d'un identifiant (None s'il n'a jamais échoué)"""
+    try:
+        conn = get_connection()
+        row = conn.execute('SELECT * FROM lookup_failures WHERE identifier = ?',
+                           (identifier.upper().strip(),)).fetchone()
+        conn.close()
+        return row
+    except Exception as e:
+        print(f"DEBUG fetch: Erreur lecture cache négatif = {e}")
+        return None
+
+def record_lookup_failure(identifier, previous=None):
+    """Enregistre un échec et repousse le prochain essai (1h, 2h, 4h... plafonné)"""
+    failures = (previous['failures'] if previous else 0) + 1
+    delay = min(LOOKUP_BACKOFF_BASE * (2 ** (failures - 1)), LOOKUP_BACKOFF_MAX)
+    now = datetime.now()
+    try:
+        conn = get_connection()
+        conn.execute('''INSERT INTO lookup_failures (identifier, failures, first_failure, last_failure, retry_after)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(identifier) DO UPDATE SET
+                            failures = excluded.failures, last_failure = excluded.last_failure,
+                            retry_after = excluded.retry_after''',
+                     (identifier.upper().strip(), failures, now.strftime('%Y-%m-%d %H:%M:%S'),
+                      now.strftime('%Y-%m-%d %H:%M:%S'), (now + delay).strftime('%Y-%m-%d %H:%M:%S')))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"DEBUG fetch: Erreur écriture cache négatif = {e}")
+
+def clear_lookup_failure(identifier):
+    """Oublie les échecs d'un identifiant (après un succès ou une correction)"""
+    try:
+        conn = get_connection()
+        conn.execute('DELETE FROM lookup_failures WHERE identifier = ?', (identifier.upper().strip(),))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"DEBUG fetch: Erreur purge cache négatif = {e}")
+
+def fetch_price_from_api(identifier, ignore_backoff=False):
+    if not identifier: return None, None, None, None
+    identifier = normalize_forced_symbol(identifier.strip())
+    print(f"DEBUG fetch: Recherche pour '{identifier}'")
+
+    # Identifiant déjà en échec : ne pas repasser par toutes les stratégies avant l'échéance
+    failure = get_lookup_failure(identifier)
+    if failure and not ignore_backoff and failure['retry_after'] > datetime.now().strftime('%Y-%m-%d %H:%M:%S'):
+        print(f"DEBUG fetch: {identifier} ignoré ({failure['failures']} échecs), prochain essai après {failure['retry_after']}")
+        return None, None, None, None
+
+    symbol, name = resolve_symbol(identifier)
+    result, no_data = fetch_quote_for_symbol(symbol, name)
+
+    if result[0] is None:
+        print(f"DEBUG fetch: Aucune donnee pour {identifier}")
+        # Cache négatif seulement si les fournisseurs ont répondu sans cours : une panne
+        # (réseau, timeout, 5xx, disjoncteur ouvert) ne met pas en cause l'identifiant
+        if no_data:
+            record_lookup_failure(identifier, failure)
+    elif failure:
+        clear_lookup_failure(identifier)
+    return result
+
+def parse_eodhd_quote(data):
+    """(prix, prix_veille) d'une cotation EODHD, (None, None) si pas de prix"""
+    def number(*fields):
+        for field in fields:
+            value = data.get(field)
+            if value not in [None, 'N/A', 'NA', '']:
+                try:
+                    return float(value)
+                except (TypeError, ValueError):
+                    pass
+        return None
+
+    # Selon endpoint EODHD, on peut recevoir close/last/adjusted_close
+    price = number('close', 'last', 'adjusted_close')
+    if price is None:
+        return None, None
+    prev_close = number('previousClose', 'previous_close', 'prev_close')
+    return price, (prev_close if prev_close is not None else price)
+
+def eodhd_quote(symbol, name, price, prev_close):
+    """Tuple de cotation (prix, nom, prix_veille, devise) à partir de valeurs EODHD brutes"""
+    currency = detect_currency_from_symbol(symbol)
+
+    # Conversion pence -> livres pour titres UK
+    if currency == 'GBP' and price > 10:
+        price = price / 100.0
+        prev_close = prev_close / 100.0
+        print(f"DEBUG fetch EODHD: Conversion pence -> livres: {price*100} -> {price}")
+
+    print(f"DEBUG fetch EODHD: Prix actuel = {price}, Prix veille = {prev_close}, Devise = {currency}")
+    return (round(price, 4), name, round(prev_close, 4), currency)
+
+def fetch_quote_for_symbol(symbol, name):
+    """Cotation d'un symbole déjà résolu : EODHD puis repli Yahoo -> (cotation, sans_donnees).
+
+    sans_donnees n'est vrai que si les deux fournisseurs ont répondu sans cours
+    (200 vide ou 404) ; une erreur réseau, un timeout ou un 5xx ne compte pas.
+    """
+    eodhd_empty = yahoo_empty = False
     # 2. Prix via EODHD (prioritaire pour cohérence des places de cotation)
     try:
-        eodhd_url = f"https://eodhd.com/api/real-time/{symbol}"
-        eodhd_resp = requests.get(
-            eodhd_url,
-            params={"api_token": EODHD_API_KEY, "fmt": "json"},
-            timeout=6
-        )
+        eodhd_url = f"{EODHD_API_URL}/real-time/{symbol}"
+        eodhd_resp = EODHD.get(eodhd_url, params={"api_token": EODHD_API_KEY, "fmt": "json"})
         print(f"DEBUG fetch EODHD: Status prix = {eodhd_resp.status_code} ({symbol})")
+        eodhd_empty = eodhd_resp.status_code in (200, 404)
         if eodhd_resp.status_code == 200:
             eodhd_data = eodhd_resp.json()
             if isinstance(eodhd_data, dict):
-                # Selon endpoint EODHD, on peut recevoir close/last/adjusted_close
-                price = eodhd_data.get('close')
-                if price in [None, 'N/A', 'NA', '']:
-                    price = eodhd_data.get('last')
-                if price in [None, 'N/A', 'NA', '']:
-                    price = eodhd_data.get('adjusted_close')
-
-                prev_close = eodhd_data.get('previousClose')
-                if prev_close in [None, 'N/A', 'NA', '']:
-                    prev_close = eodhd_data.get('previous_close')
-
-                if price not in [None, 'N/A', 'NA', '']:
-                    price = float(price)
-                    prev_close = float(prev_close) if prev_close not in [None, 'N/A', 'NA', ''] else price
-                    currency = detect_currency_from_symbol(symbol)
-
-                    # Conversion pence -> livres pour titres UK
-                    if currency == 'GBP' and price > 10:
-                        price = price / 100.0
-                        prev_close = prev_close / 100.0
-                        print(f"DEBUG fetch EODHD: Conversion pence -> livres: {price*100} -> {price}")
-
-                    print(f"DEBUG fetch EODHD: Prix actuel = {price}, Prix veille = {prev_close}, Devise = {currency}")
-                    return (round(price, 4), name, round(prev_close, 4), currency)
+                price, prev_close = parse_eodhd_quote(eodhd_data)
+                if price is not None:
+                    return eodhd_quote(symbol, name, price, prev_close), False
     except Exception as e:
+        eodhd_empty = False
         print(f"DEBUG fetch EODHD: Erreur prix = {e}")
 
     # 3. Fallback Yahoo
     try:
         chart_url = f"https://query1.finance.yahoo.com/v8/finance/chart/{symbol}?interval=1m&range=1d"
-        res = requests.get(chart_url, headers=headers, timeout=10)
+        res = YAHOO.get(chart_url)
         print(f"DEBUG fetch: Status prix = {res.status_code}")
+        yahoo_empty = res.status_code in (200, 404)
         if res.status_code == 200:
             data = res.json()
             result = data.get('chart', {}).get('result')
@@ -567,12 +1343,780 @@ def fetch_price_from_api(identifier):
                 
                 print(f"DEBUG fetch: Prix actuel = {price}, Prix veille = {prev_close}, Devise = {currency}")
                 if price is not None:
-                    return (round(float(price), 4), name, round(float(prev_close or price), 4), currency)
+                    return (round(float(price), 4), name, round(float(prev_close or price), 4), currency), False
     except Exception as e:
+        yahoo_empty = False
         print(f"DEBUG fetch: Erreur prix = {e}")
 
-    print(f"DEBUG fetch: Aucune donnee pour {identifier}")
-    return None, None, None, None
+    return (None, None, None, None), eodhd_empty and yahoo_empty
+
+# --- COTATIONS GROUPÉES EODHD (bulk) ---
+# 'auto' : bulk de fin de journée par place hors séance, real-time multi-symboles sinon ; 'off' : désactivé
+EODHD_BULK_MODE = os.environ.get('EODHD_BULK_MODE', 'auto').lower()
+# Places couvertes par le bulk de fin de journée (eod-bulk-last-day)
+EODHD_BULK_EXCHANGES = tuple(x.strip().upper() for x in os.environ.get('EODHD_BULK_EXCHANGES', 'PA,BR').split(',') if x.strip())
+# Symboles par requête real-time multi-symboles (EODHD en recommande une quinzaine)
+EODHD_REALTIME_BATCH = max(1, safe_int(os.environ.get('EODHD_REALTIME_BATCH'), 15))
+# Symboles minimum d'une place pour passer par le bulk (qui coûte EODHD_COST_BULK appels) :
+# en dessous, le real-time groupé (1 appel décompté par symbole) est moins cher
+EODHD_BULK_MIN_SYMBOLS = safe_int(os.environ.get('EODHD_BULK_MIN_SYMBOLS'), EODHD_COST_BULK)
+# Heure UTC à partir de laquelle le bulk de fin de journée contient la séance du jour
+EODHD_BULK_READY_UTC_HOUR = safe_int(os.environ.get('EODHD_BULK_READY_UTC_HOUR'), 19)
+BULK_SYMBOL_RE = re.compile(r'^[A-Z0-9][A-Z0-9\-]*\.[A-Z]{1,4}$')
+
+def expected_eod_date(now=None):
+    """Date de séance attendue dans le bulk de fin de journée, None pendant les heures de marché"""
+    now = now or datetime.utcnow()
+    if now.weekday() < 5:
+        if now.hour >= EODHD_BULK_READY_UTC_HOUR:
+            return now.strftime('%Y-%m-%d')
+        if now.hour >= 7:
+            return None  # Séance en cours (ou clôture pas encore publiée) : real-time uniquement
+    # Avant l'ouverture ou le week-end : dernière séance ouvrée
+    day = now - timedelta(days=1)
+    while day.weekday() >= 5:
+        day -= timedelta(days=1)
+    return day.strftime('%Y-%m-%d')
+
+def fetch_bulk_last_day(exchange, symbols, expected_date):
+    """Clôtures du jour de toute une place en un appel -> {symbole: (prix, prix_veille)}"""
+    codes = {s.rsplit('.', 1)[0]: s for s in symbols}
+    resp = EODHD.get(f"{EODHD_API_URL}/eod-bulk-last-day/{exchange}",
+                     params={"api_token": EODHD_API_KEY, "fmt": "json", "filter": "extended",
+                             "symbols": ','.join(codes)},
+                     cost=EODHD_COST_BULK)
+    data = resp.json() if resp.status_code == 200 else []
+    prices = {}
+    for item in data if isinstance(data, list) else []:
+        symbol = codes.get(str(item.get('code', '')).upper())
+        # Une ligne d'une séance antérieure n'est pas la clôture attendue : repli real-time
+        if symbol and (item.get('date') or '') >= expected_date:
+            price, prev_close = parse_eodhd_quote(item)
+            if price is not None:
+                prices[symbol] = (price, prev_close)
+    return prices
+
+def fetch_realtime_batch(symbols):
+    """Cotations real-time de plusieurs symboles en un appel (paramètre s=) -> {symbole: (prix, prix_veille)}.
+
+    Lève requests.HTTPError si EODHD ne répond pas 200 (un dict vide signifie
+    que le fournisseur a répondu sans cours).
+    """
+    resp = EODHD.get(f"{EODHD_API_URL}/real-time/{symbols[0]}",
+                     params={"s": ','.join(symbols[1:]), "api_token": EODHD_API_KEY, "fmt": "json"},
+                     cost=len(symbols))
+    if resp.status_code != 200:
+        raise requests.HTTPError(f"real-time groupé : statut {resp.status_code}")
+    data = resp.json()
+    wanted = set(symbols)
+    prices = {}
+    for item in data if isinstance(data, list) else [data]:
+        symbol = str(item.get('code', '')).upper() if isinstance(item, dict) else ''
+        if symbol in wanted:
+            price, prev_close = parse_eodhd_quote(item)
+            if price is not None:
+                prices[symbol] = (price, prev_close)
+    return prices
+
+def fetch_bulk_quotes(symbols):
+    """Cote un univers de symboles EODHD en quelques appels groupés.
+
+    Bulk de fin de journée hors séance pour les places d'au moins
+    EODHD_BULK_MIN_SYMBOLS symboles, puis real-time multi-symboles
+    par lots de EODHD_REALTIME_BATCH. Retourne {symbole: (prix, prix_veille)} ;
+    les symboles absents restent à coter un par un par l'appelant.
+    """
+    symbols = list(dict.fromkeys(s.upper() for s in symbols if s and BULK_SYMBOL_RE.match(s.upper())))
+    if EODHD_BULK_MODE == 'off' or not symbols:
+        return {}
+    prices = {}
+    expected_date = expected_eod_date()
+    if expected_date:
+        for exchange in EODHD_BULK_EXCHANGES:
+            members = [s for s in symbols if s.endswith(f'.{exchange}')]
+            if members and len(members) >= EODHD_BULK_MIN_SYMBOLS:
+                try:
+                    prices.update(fetch_bulk_last_day(exchange, members, expected_date))
+                except Exception as e:
+                    print(f"DEBUG bulk: Erreur eod-bulk-last-day {exchange} = {e}")
+    missing = [s for s in symbols if s not in prices]
+    for i in range(0, len(missing), EODHD_REALTIME_BATCH):
+        batch = missing[i:i + EODHD_REALTIME_BATCH]
+        try:
+            prices.update(fetch_realtime_batch(batch))
+        except Exception as e:
+            print(f"DEBUG bulk: Erreur real-time groupé ({len(batch)} symboles) = {e}")
+    print(f"DEBUG bulk: {len(prices)}/{len(symbols)} symboles cotés par appels groupés")
+    return prices
+
+# --- TAUX DE CHANGE QUOTIDIENS ---
+# Devises suivies (en plus de celles des positions), paires EODHD EURxxx.FOREX
+FX_CURRENCIES = tuple(x.strip().upper() for x in os.environ.get('FX_CURRENCIES', 'USD,GBP').split(',') if x.strip())
+# Profondeur du premier remplissage de l'historique des taux (jours)
+FX_BACKFILL_DAYS = safe_int(os.environ.get('FX_BACKFILL_DAYS'), 730)
+fx_lock = threading.Lock()
+
+def load_fx_snapshot(conn):
+    """Construit l'instantané avec le dernier taux connu de chaque devise et le publie"""
+    global fx_snapshot
+    rows = conn.execute('''SELECT devise, rate, stale FROM fx_rates f 
+                           WHERE date = (SELECT MAX(date) FROM fx_rates WHERE devise = f.devise)''').fetchall()
+    snapshot = FxSnapshot(datetime.now().strftime('%Y-%m-%d'), {r['devise']: r['rate'] for r in rows},
+                          [r['devise'] for r in rows if r['stale']])
+    fx_snapshot = snapshot  # Remplacement atomique : les lecteurs gardent l'ancien objet jusqu'au bout
+    return snapshot
+
+def get_fx_snapshot():
+    """Instantané des taux du jour (relu depuis la base au premier appel de la journée)"""
+    snapshot = fx_snapshot
+    if snapshot.day == datetime.now().strftime('%Y-%m-%d'):
+        return snapshot
+    with fx_lock:
+        if fx_snapshot.day == datetime.now().strftime('%Y-%m-%d'):
+            return fx_snapshot
+        try:
+            conn = get_connection()
+            try:
+                return load_fx_snapshot(conn)
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"DEBUG fx: Erreur lecture taux = {e}")
+            return snapshot
+
+def refresh_fx_rates(conn):
+    """Complète fx_rates une fois par jour depuis EODHD (sans commit) et republie l'instantané.
+
+    Historique EOD depuis le dernier jour stocké (FX_BACKFILL_DAYS au premier
+    passage), puis taux temps réel du jour pour toutes les devises en un appel.
+    Une devise sans cotation du jour alors qu'EODHD a bien répondu reprend son
+    dernier taux réel, marqué stale : la journée est close et le taux est corrigé
+    par l'historique du lendemain. En cas de panne, rien n'est écrit et le
+    passage suivant réessaie.
+    """
+    today = datetime.now().strftime('%Y-%m-%d')
+    held = {r['devise_cotation'] for r in conn.execute('SELECT DISTINCT devise_cotation FROM actifs').fetchall()}
+    currencies = sorted((set(FX_CURRENCIES) | held) - {None, '', 'EUR'})
+    # Dernier taux réel (les taux reconduits ne comptent pas comme historique)
+    last_dates = {r['devise']: r['last'] for r in conn.execute(
+        'SELECT devise, MAX(date) AS last FROM fx_rates WHERE stale = 0 GROUP BY devise').fetchall()}
+    closed = {r['devise'] for r in conn.execute('SELECT devise FROM fx_rates WHERE date = ?', (today,)).fetchall()}
+    pending = [cur for cur in currencies if cur not in closed]
+    if not pending:
+        return 0
+    rows = []
+    answered = set()
+    for cur in pending:
+        start = last_dates.get(cur) or (datetime.now() - timedelta(days=FX_BACKFILL_DAYS)).strftime('%Y-%m-%d')
+        try:
+            resp = EODHD.get(f"{EODHD_API_URL}/eod/EUR{cur}.FOREX",
+                             params={"from": start, "api_token": EODHD_API_KEY, "fmt": "json"})
+            data = resp.json() if resp.status_code == 200 else None
+            if isinstance(data, list):
+                answered.add(cur)
+            for candle in data if isinstance(data, list) else []:
+                rate = eod_value(candle, 'close') if isinstance(candle, dict) else None
+                if rate and candle.get('date'):
+                    rows.append((cur, candle['date'], rate))
+        except Exception as e:
+            print(f"DEBUG fx: Erreur historique EUR{cur} = {e}")
+    try:
+        quotes = fetch_realtime_batch([f"EUR{cur}.FOREX" for cur in pending])
+        rows += [(symbol[3:6], today, price) for symbol, (price, _) in quotes.items() if price]
+    except Exception as e:
+        answered.clear()
+        print(f"DEBUG fx: Erreur taux du jour = {e}")
+    conn.executemany('''INSERT INTO fx_rates (devise, date, rate, stale) VALUES (?, ?, ?, 0) 
+                        ON CONFLICT(devise, date) DO UPDATE SET rate = excluded.rate, stale = 0''', rows)
+    # Cotation du jour absente d'une réponse valide : dernier taux réel reconduit (marqué stale),
+    # seulement pour une devise qui a déjà un historique réel
+    quoted = {cur for cur, day, _ in rows if day == today}
+    known = {cur for cur, _, _ in rows} | set(last_dates)
+    missing = [cur for cur in pending if cur not in quoted and cur in answered and cur in known]
+    conn.executemany('''INSERT INTO fx_rates (devise, date, rate, stale) 
+                        VALUES (?, ?, (SELECT rate FROM fx_rates WHERE devise = ? AND stale = 0 ORDER BY date DESC LIMIT 1), 1) 
+                        ON CONFLICT(devise, date) DO NOTHING''',
+                     [(cur, today, cur) for cur in missing])
+    load_fx_snapshot(conn)
+    print(f"DEBUG fx: {len(rows)} taux enregistrés ({', '.join(pending)}), reconduits : {', '.join(missing) or 'aucun'}")
+    return len(rows)
+
+def fx_rate_table(conn, currencies, dates):
+    """Taux du jour par devise {devise: [taux pour chaque date]} (unités pour 1 EUR) :
+    dernier taux connu à chaque date, taux de l'instantané avant le premier historique"""
+    currencies = sorted(set(currencies) - {'EUR'})
+    table = {'EUR': [1.0] * len(dates)}
+    if not currencies or not dates:
+        return table
+    rows = conn.execute('''SELECT devise, date, rate FROM fx_rates 
+                           WHERE devise IN (SELECT value FROM json_each(?)) AND date <= ? 
+                           ORDER BY devise, date''', (json.dumps(currencies), dates[-1])).fetchall()
+    current = get_fx_snapshot().rates
+    by_currency = {}
+    for r in rows:
+        by_currency.setdefault(r['devise'], []).append((r['date'], r['rate']))
+    for cur in currencies:
+        history = by_currency.get(cur, [])
+        rate, k, series = current.get(cur, 1.0), 0, []
+        # Taux antérieur à la première date (amorce du forward-fill)
+        while k < len(history) and history[k][0] < dates[0]:
+            rate, k = history[k][1], k + 1
+        for day in dates:
+            while k < len(history) and history[k][0] <= day:
+                rate, k = history[k][1], k + 1
+            series.append(rate)
+        table[cur] = series
+    return table
+
+def quote_key(ticker):
+    """Clé de déduplication d'un ticker (symbole normalisé, majuscules)"""
+    return (normalize_forced_symbol((ticker or '').strip()) or '').upper()
+
+# Nombre maximum de cotations récupérées en parallèle pendant une mise à jour des prix
+PRICE_FETCH_WORKERS = max(1, safe_int(os.environ.get('PRICE_FETCH_WORKERS'), 8))
+
+def build_quote_table(tickers, max_workers=PRICE_FETCH_WORKERS, on_progress=None):
+    """Récupère une seule cotation par symbole distinct (appels groupés EODHD, puis en parallèle).
+
+    Retourne un dict {clé normalisée: (prix, nom, prix_veille, devise)} partagé
+    par toutes les positions qui détiennent le même titre. Les threads ne font
+    que des appels réseau : l'écriture en base reste à l'appelant (écrivain unique).
+    on_progress(faits, total) est appelé après chaque symbole.
+    """
+    symbols = list(dict.fromkeys(key for key in map(quote_key, tickers) if key))
+    if not symbols:
+        return {}
+
+    # 1. Appels groupés pour les symboles déjà connus (résolution en cache ou suffixe de place)
+    bulk_symbols = {}
+    for key in symbols:
+        cached = get_cached_resolution(key)
+        if cached:
+            bulk_symbols[key] = (cached['symbol'].upper(), cached['name'] or cached['symbol'])
+        elif BULK_SYMBOL_RE.match(key):
+            bulk_symbols[key] = (key, key)
+    bulk_prices = fetch_bulk_quotes(symbol for symbol, _ in bulk_symbols.values())
+    quotes = {}
+    for key, (symbol, name) in bulk_symbols.items():
+        if symbol in bulk_prices:
+            quotes[key] = eodhd_quote(symbol, name, *bulk_prices[symbol])
+    if on_progress and quotes:
+        on_progress(len(quotes), len(symbols))
+
+    # 2. Repli un par un (résolution, EODHD puis Yahoo) pour le reste
+    remaining = [s for s in symbols if s not in quotes]
+    if not remaining:
+        return quotes
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(remaining))) as executor:
+        fetch = with_priority(fetch_price_from_api)
+        future_to_symbol = {executor.submit(fetch, s): s for s in remaining}
+        for future in concurrent.futures.as_completed(future_to_symbol):
+            symbol = future_to_symbol[future]
+            try:
+                quotes[symbol] = future.result()
+            except Exception as e:
+                print(f"Erreur cotation {symbol}: {e}")
+                quotes[symbol] = (None, None, None, None)
+            if on_progress:
+                on_progress(len(quotes), len(symbols))
+    return quotes
+
+# --- RÉSUMÉ DE PORTEFEUILLE (matérialisé) ---
+# Les totaux du dashboard sont recalculés à l'écriture (mise à jour des prix,
+# ajout/modification/suppression d'actif ou de compte) et stockés dans
+# portfolio_summary / compte_summary : l'affichage lit une ligne par compte.
+def compute_portfolio_summary(actifs):
+    """Agrège les positions (lignes actifs + cumul_pv_mois) en totaux EUR.
+
+    Les montants sont cumulés en devise de cotation par (compte, devise) puis
+    convertis une seule fois par groupe avec l'instantané des taux du jour.
+    """
+    buckets = {}
+    total_month_pv = 0
+    comptes_stats = {}
+
+    # Pour trouver les top/bottom performers du jour
+    day_performances = []
+
+    for a in actifs:
+        p_actuel = safe_float(a['prix_actuel'])
+        p_achat = safe_float(a['prix_achat'])
+        p_veille = safe_float(a['prix_veille'])
+
+        qty = safe_int(a['quantite'])
+        frais = safe_float(a['frais'])
+        try:
+            devise_cotation = a['devise_cotation'] or 'EUR'
+        except (KeyError, IndexError):
+            devise_cotation = 'EUR'
+
+        # Calculer les valeurs dans la devise de cotation
+        val_actuelle = (p_actuel * qty) + frais
+        val_achat = (p_achat * qty) + frais
+        val_veille = (p_veille * qty) + frais
+
+        pv = val_actuelle - val_achat
+
+        # PV du jour : détecter si prix_veille est aberrant
+        # Si prix_veille est trop éloigné du prix actuel (> 20% d'écart), utiliser prix_achat
+        if p_veille == 0 or abs(p_veille - p_actuel) > (p_actuel * 0.20):
+            # Prix de veille aberrant : calculer par rapport au prix d'achat
+            day_pv = val_actuelle - val_achat
+        else:
+            # Prix de veille normal : calculer la variation du jour
+            day_pv = val_actuelle - val_veille
+
+        # Cumul du mois (chargé avec les positions via la jointure sur cumul_pv_mois)
+        # IMPORTANT : SEULEMENT le cumul (PAS la PV du jour en cours)
+        # Le cumul sera mis à jour à 17h45 par le CRON
+        # Pas encore de cumul pour ce mois : safe_float(None) -> 0
+        month_pv_eur = safe_float(a['cumul_pv_mois'])
+
+        # Calcul de la variation journalière en %
+        if p_veille > 0:
+            day_perf_pct = ((p_actuel - p_veille) / p_veille) * 100
+            day_performances.append({'nom': a['nom_actif'], 'perf': day_perf_pct})
+
+        # Additionner en devise de cotation (conversion EUR par groupe plus bas)
+        bucket = buckets.setdefault((a['compte_id'], devise_cotation), [0, 0, 0, 0])
+        bucket[0] += val_achat
+        bucket[1] += val_actuelle
+        bucket[2] += pv
+        bucket[3] += day_pv
+
+        # Le cumul du mois est déjà en EUR
+        total_month_pv += month_pv_eur
+        stats = comptes_stats.setdefault(a['compte_id'], {'achat': 0, 'actuel': 0, 'pv': 0, 'day_pv': 0, 'month_pv': 0})
+        stats['month_pv'] += month_pv_eur
+
+    # Convertir vers EUR (devise de référence) : un facteur par groupe
+    fx = get_fx_snapshot()
+    total_achat = total_actuel = total_pv = total_day_pv = 0
+    for (compte_id, devise_cotation), (achat, actuel, pv, day_pv) in buckets.items():
+        factor = fx.to_eur_factor(devise_cotation)
+        stats = comptes_stats[compte_id]
+        stats['achat'] += achat * factor
+        stats['actuel'] += actuel * factor
+        stats['pv'] += pv * factor
+        stats['day_pv'] += day_pv * factor
+        total_achat += achat * factor
+        total_actuel += actuel * factor
+        total_pv += pv * factor
+        total_day_pv += day_pv * factor
+
+    # Trouver les top/bottom performers
+    top_gainer = max(day_performances, key=lambda x: x['perf']) if day_performances else None
+    top_loser = min(day_performances, key=lambda x: x['perf']) if day_performances else None
+
+    return {'total_achat': total_achat, 'total_actuel': total_actuel, 'total_pv': total_pv,
+            'total_day_pv': total_day_pv, 'total_month_pv': total_month_pv,
+            'comptes_stats': comptes_stats, 'top_gainer': top_gainer, 'top_loser': top_loser}
+
+def refresh_portfolio_summary(conn, user_id):
+    """Recalcule et enregistre le résumé d'un utilisateur (sans commit)"""
+    mois_actuel = datetime.now().strftime("%Y-%m")
+    # Positions + cumul du mois en une seule requête
+    actifs = conn.execute('''SELECT a.*, cm.cumul_pv AS cumul_pv_mois FROM actifs a 
+                            JOIN comptes c ON a.compte_id = c.id 
+                            LEFT JOIN cumul_pv_mois cm ON cm.actif_id = a.id AND cm.mois = ?
+                            WHERE c.user_id = ?''', (mois_actuel, user_id)).fetchall()
+    summary = compute_portfolio_summary(actifs)
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    top_gainer = summary['top_gainer'] or {}
+    top_loser = summary['top_loser'] or {}
+
+    conn.execute('''INSERT OR REPLACE INTO portfolio_summary
+                    (user_id, mois, total_achat, total_actuel, total_pv, total_day_pv, total_month_pv,
+                     top_gainer_nom, top_gainer_perf, top_loser_nom, top_loser_perf, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                 (user_id, mois_actuel, summary['total_achat'], summary['total_actuel'], summary['total_pv'],
+                  summary['total_day_pv'], summary['total_month_pv'],
+                  top_gainer.get('nom'), top_gainer.get('perf'), top_loser.get('nom'), top_loser.get('perf'), now))
+    conn.execute('DELETE FROM compte_summary WHERE user_id = ?', (user_id,))
+    conn.executemany('''INSERT INTO compte_summary (compte_id, user_id, achat, actuel, pv, day_pv, month_pv, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                     [(compte_id, user_id, st['achat'], st['actuel'], st['pv'], st['day_pv'], st['month_pv'], now)
+                      for compte_id, st in summary['comptes_stats'].items()])
+    return summary
+
+def refresh_all_portfolio_summaries(conn, user_ids=None):
+    """Recalcule les résumés de plusieurs utilisateurs (tous par défaut, sans commit)"""
+    if user_ids is None:
+        user_ids = [r['id'] for r in conn.execute('SELECT id FROM users').fetchall()]
+    for user_id in user_ids:
+        refresh_portfolio_summary(conn, user_id)
+
+def load_portfolio_summary(conn, user_id):
+    """Lit le résumé matérialisé ; le reconstruit s'il manque ou date d'un autre mois"""
+    row = conn.execute('SELECT * FROM portfolio_summary WHERE user_id = ?', (user_id,)).fetchone()
+    if not row or row['mois'] != datetime.now().strftime("%Y-%m"):
+        summary = refresh_portfolio_summary(conn, user_id)
+        conn.commit()
+        return summary
+
+    comptes_stats = {r['compte_id']: {'achat': r['achat'], 'actuel': r['actuel'], 'pv': r['pv'],
+                                      'day_pv': r['day_pv'], 'month_pv': r['month_pv']}
+                     for r in conn.execute('SELECT * FROM compte_summary WHERE user_id = ?', (user_id,)).fetchall()}
+    top_gainer = {'nom': row['top_gainer_nom'], 'perf': row['top_gainer_perf']} if row['top_gainer_perf'] is not None else None
+    top_loser = {'nom': row['top_loser_nom'], 'perf': row['top_loser_perf']} if row['top_loser_perf'] is not None else None
+    return {'total_achat': row['total_achat'], 'total_actuel': row['total_actuel'], 'total_pv': row['total_pv'],
+            'total_day_pv': row['total_day_pv'], 'total_month_pv': row['total_month_pv'],
+            'comptes_stats': comptes_stats, 'top_gainer': top_gainer, 'top_loser': top_loser}
+
+# --- CUMUL MENSUEL (ouverture de mois, archivage, recalcul) ---
+# Opérations ensemblistes : un nombre fixe d'instructions SQL quel que soit le
+# nombre d'actifs. `user_id` limite l'opération à un utilisateur (None : tous).
+def month_bounds(mois):
+    """('AAAA-MM-01', 'AAAA-MM-01' du mois suivant) pour un mois 'AAAA-MM'"""
+    debut = datetime.strptime(mois, '%Y-%m')
+    suivant = (debut.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return debut.strftime('%Y-%m-%d'), suivant.strftime('%Y-%m-%d')
+
+def previous_month(mois):
+    return (datetime.strptime(mois, '%Y-%m') - timedelta(days=1)).strftime('%Y-%m')
+
+USER_ACTIFS_FILTER = '(? IS NULL OR a.compte_id IN (SELECT id FROM comptes WHERE user_id = ?))'
+
+def open_month(conn, mois, user_id=None):
+    """Ouvre `mois` : cumul à 0 pour chaque actif (créé ou remis à zéro), sans commit"""
+    today = datetime.now().strftime('%Y-%m-%d')
+    return conn.execute(f'''INSERT INTO cumul_pv_mois (actif_id, mois, cumul_pv, derniere_mise_a_jour) 
+                            SELECT a.id, ?, 0, ? FROM actifs a WHERE {USER_ACTIFS_FILTER} 
+                            ON CONFLICT(actif_id, mois) DO UPDATE SET 
+                                cumul_pv = 0, derniere_mise_a_jour = excluded.derniere_mise_a_jour''',
+                        (mois, today, user_id, user_id)).rowcount
+
+def recompute_month_cumul(conn, mois, user_id=None):
+    """Recalcule le cumul de `mois` depuis historique_prix (sans commit).
+
+    PV d'un jour = (prix - prix du relevé précédent) x quantité, convertie en EUR
+    au taux du jour (fx_rates, à défaut l'instantané courant) ;
+    le premier relevé du mois se compare au dernier du mois précédent. Corrige
+    la dérive de l'accumulateur quand un passage du cron a été manqué.
+
+    Mois en cours : seuls les jours clos sont comptés, sauf pour les actifs dont
+    le cron a déjà ajouté la PV du jour (marqueur à aujourd'hui) ; le marqueur
+    derniere_mise_a_jour garde ainsi son sens « dernier jour ajouté ».
+    """
+    debut, fin = month_bounds(mois)
+    today = datetime.now().strftime('%Y-%m-%d')
+    counted_today = [r['actif_id'] for r in conn.execute(
+        'SELECT actif_id FROM cumul_pv_mois WHERE mois = ? AND derniere_mise_a_jour = ?', (mois, today)).fetchall()]
+    # Upsert : les actifs sans relevé sur le mois gardent leur ligne telle quelle
+    return conn.execute(f'''INSERT INTO cumul_pv_mois (actif_id, mois, cumul_pv, derniere_mise_a_jour) 
+                            SELECT actif_id, ?, SUM(COALESCE(pv_eur, 0)), MAX(date) FROM (
+                                SELECT h.actif_id, h.date, 
+                                       (h.prix - LAG(h.prix) OVER (PARTITION BY h.actif_id ORDER BY h.date)) 
+                                           * a.quantite / COALESCE(
+                                           (SELECT r.rate FROM fx_rates r WHERE r.devise = h.devise 
+                                            AND r.date <= substr(h.date, 1, 10) ORDER BY r.date DESC LIMIT 1), 
+                                           fx.rate, 1.0) AS pv_eur 
+                                FROM historique_prix h 
+                                JOIN actifs a ON a.id = h.actif_id 
+                                LEFT JOIN (SELECT key AS devise, value AS rate FROM json_each(?)) fx ON fx.devise = h.devise 
+                                WHERE {USER_ACTIFS_FILTER} AND h.date < ? 
+                                  AND (h.date < ? OR h.actif_id IN (SELECT value FROM json_each(?))) 
+                                  AND h.date >= COALESCE((SELECT MAX(p.date) FROM historique_prix p 
+                                                          WHERE p.actif_id = h.actif_id AND p.date < ?), ?)) 
+                            WHERE date >= ? 
+                            GROUP BY actif_id 
+                            ON CONFLICT(actif_id, mois) DO UPDATE SET 
+                                cumul_pv = excluded.cumul_pv, derniere_mise_a_jour = excluded.derniere_mise_a_jour''',
+                        (mois, json.dumps(get_fx_snapshot().rates), user_id, user_id, fin,
+                         min(fin, today), json.dumps(counted_today), debut, debut, debut)).rowcount
+
+def archive_month(conn, mois, user_id=None):
+    """Archive les totaux de `mois` par utilisateur et par compte (sans commit)"""
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return conn.execute(f'''INSERT INTO monthly_pv_archive (user_id, compte_id, mois, cumul_pv, nb_actifs, closed_at) 
+                            SELECT c.user_id, a.compte_id, cm.mois, SUM(cm.cumul_pv), COUNT(*), ? 
+                            FROM cumul_pv_mois cm 
+                            JOIN actifs a ON a.id = cm.actif_id 
+                            JOIN comptes c ON c.id = a.compte_id 
+                            WHERE cm.mois = ? AND {USER_ACTIFS_FILTER} 
+                            GROUP BY c.user_id, a.compte_id 
+                            ON CONFLICT(user_id, compte_id, mois) DO UPDATE SET 
+                                cumul_pv = excluded.cumul_pv, nb_actifs = excluded.nb_actifs, closed_at = excluded.closed_at''',
+                        (now, mois, user_id, user_id)).rowcount
+
+def rollover_month(conn, mois, user_id=None):
+    """Passage au mois `mois` : archivage du cumul du mois qui se clôt tel qu'affiché, puis ouverture (sans commit).
+
+    Le recalcul depuis l'historique reste explicite (/api/recompute_cumul).
+    """
+    closing = previous_month(mois)
+    archived = archive_month(conn, closing, user_id)
+    opened = open_month(conn, mois, user_id)
+    return {'mois_cloture': closing, 'comptes_archives': archived, 'ouverts': opened}
+
+# --- HISTORIQUE DE VALORISATION DU PORTEFEUILLE ---
+# Valeur quotidienne de chaque compte = somme des (prix du jour x quantité + frais)
+# convertie en EUR, avec les quantités actuelles ; un actif sans cours ce jour-là
+# garde son dernier prix connu. Stockée dans portfolio_history, complétée après
+# chaque mise à jour des prix et reconstruite si les positions changent.
+def portfolio_positions(conn, user_id):
+    """Positions d'un utilisateur et leur empreinte (quantités, frais, devise, compte)"""
+    positions = conn.execute('''SELECT a.id, a.compte_id, a.quantite, a.frais, a.devise_cotation 
+                                FROM actifs a JOIN comptes c ON a.compte_id = c.id 
+                                WHERE c.user_id = ? ORDER BY a.id''', (user_id,)).fetchall()
+    fingerprint = hashlib.sha1(json.dumps([tuple(p) for p in positions]).encode('utf-8')).hexdigest()
+    return positions, fingerprint
+
+def compute_portfolio_history(conn, positions, since=None):
+    """Valeurs quotidiennes par compte depuis `since` (toutes les dates si None).
+
+    Un seul chargement des cours, puis calcul matriciel (positions x dates) avec
+    NumPy ; repli en Python pur si NumPy est absent. Retourne [(compte_id, date, valeur)].
+    """
+    if not positions:
+        return []
+    ids = json.dumps([p['id'] for p in positions])
+    since = since or '0000-00-00'
+    # Cours de la période + dernier cours antérieur de chaque actif (amorce du forward-fill)
+    rows = conn.execute('''SELECT actif_id, substr(date, 1, 10) AS day, prix FROM historique_prix 
+                           WHERE actif_id IN (SELECT value FROM json_each(?)) AND date >= ? AND prix IS NOT NULL 
+                           UNION ALL 
+                           SELECT actif_id, '0000-00-00', prix FROM (
+                               SELECT actif_id, MAX(date), prix FROM historique_prix 
+                               WHERE actif_id IN (SELECT value FROM json_each(?)) AND date < ? AND prix IS NOT NULL 
+                               GROUP BY actif_id)''', (ids, since, ids, since)).fetchall()
+    dates = sorted({r['day'] for r in rows} - {'0000-00-00'})
+    if not dates:
+        return []
+    columns = ['0000-00-00'] + dates
+    date_index = {d: i for i, d in enumerate(columns)}
+    position_index = {p['id']: i for i, p in enumerate(positions)}
+    quantities = [safe_float(p['quantite']) for p in positions]
+    fees = [safe_float(p['frais']) for p in positions]
+    # Taux du jour de chaque date (historique fx_rates), pas le taux courant
+    rates = fx_rate_table(conn, {p['devise_cotation'] or 'EUR' for p in positions}, dates)
+    fx = [[1.0 / rate for rate in rates[p['devise_cotation'] or 'EUR']] for p in positions]
+    compte_ids = sorted({p['compte_id'] for p in positions})
+
+    np = lazy_import('numpy')
+    if np is not None:
+        prices = np.full((len(positions), len(columns)), np.nan)
+        for r in rows:
+            prices[position_index[r['actif_id']], date_index[r['day']]] = r['prix']
+        prices = forward_fill(np, prices)[:, 1:]
+        # Valeur EUR de chaque position ; 0 tant que l'actif n'a pas de cours
+        values = np.where(np.isnan(prices), 0.0,
+                          (prices * np.array(quantities)[:, None] + np.array(fees)[:, None]) * np.array(fx))
+        # Somme par compte : matrice d'appartenance (comptes x positions) @ valeurs (positions x dates)
+        membership = np.array([[1.0 if p['compte_id'] == cid else 0.0 for p in positions] for cid in compte_ids])
+        totals = (membership @ values).tolist()
+    else:
+        last_price = [None] * len(positions)
+        by_day = {}
+        for r in rows:
+            by_day.setdefault(r['day'], []).append(r)
+        totals = [[0.0] * len(dates) for _ in compte_ids]
+        compte_row = {cid: i for i, cid in enumerate(compte_ids)}
+        for col, day in enumerate(columns):
+            for r in by_day.get(day, []):
+                last_price[position_index[r['actif_id']]] = r['prix']
+            if col == 0:
+                continue
+            for i, p in enumerate(positions):
+                if last_price[i] is not None:
+                    totals[compte_row[p['compte_id']]][col - 1] += (last_price[i] * quantities[i] + fees[i]) * fx[i][col - 1]
+    return [(cid, day, round(totals[i][j], 2)) for i, cid in enumerate(compte_ids) for j, day in enumerate(dates)]
+
+def refresh_portfolio_history(conn, user_id, full=False):
+    """Complète (ou reconstruit) l'historique de valorisation d'un utilisateur (sans commit).
+
+    Incrémental : seules les dates à partir de la dernière déjà calculée sont
+    recalculées ; reconstruction complète si les positions ont changé.
+    """
+    positions, fingerprint = portfolio_positions(conn, user_id)
+    state = conn.execute('SELECT * FROM portfolio_history_state WHERE user_id = ?', (user_id,)).fetchone()
+    if full or not state or state['positions_hash'] != fingerprint:
+        since = None
+        conn.execute('DELETE FROM portfolio_history WHERE user_id = ?', (user_id,))
+    else:
+        since = state['last_date']
+    rows = compute_portfolio_history(conn, positions, since)
+    conn.executemany('''INSERT OR REPLACE INTO portfolio_history (user_id, compte_id, date, valeur) 
+                        VALUES (?, ?, ?, ?)''', [(user_id, cid, day, valeur) for cid, day, valeur in rows])
+    last_date = max((day for _, day, _ in rows), default=state['last_date'] if since else None)
+    conn.execute('''INSERT OR REPLACE INTO portfolio_history_state (user_id, positions_hash, last_date, updated_at) 
+                    VALUES (?, ?, ?, ?)''', (user_id, fingerprint, last_date, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    return len(rows)
+
+# --- TÂCHES DE FOND (gestionnaire de jobs) ---
+# Les mises à jour (prix, analyse marché, analyse ETF) passent par un
+# gestionnaire unique : un second déclenchement pendant qu'un job de même clé
+# tourne s'y rattache au lieu d'en lancer un autre (single-flight), et le
+# nombre de jobs actifs simultanément est borné par JOB_MAX_CONCURRENT.
+JOB_MAX_CONCURRENT = max(1, safe_int(os.environ.get('JOB_MAX_CONCURRENT'), 2))
+
+class Job:
+    """Un job de fond : état, progression et durées (persistés dans la table jobs)"""
+
+    def __init__(self, job_type, key):
+        self.id = None
+        self.job_type = job_type
+        self.key = key
+        self.state = 'queued'
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.processed = 0
+        self.total = 0
+        self.message = ''
+        self.error = None
+        self.done = threading.Event()
+
+    def update(self, processed=None, total=None, message=None):
+        """Met à jour la progression (en mémoire ; persistée aux changements d'état)"""
+        if processed is not None:
+            self.processed = processed
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self.message = message
+
+    def duration_ms(self):
+        if not self.started_at:
+            return None
+        end = self.finished_at or datetime.now()
+        return round((end - self.started_at).total_seconds() * 1000, 1)
+
+    def to_dict(self):
+        fmt = '%Y-%m-%d %H:%M:%S'
+        return {'id': self.id, 'type': self.job_type, 'key': self.key, 'state': self.state,
+                'created_at': self.created_at.strftime(fmt),
+                'started_at': self.started_at.strftime(fmt) if self.started_at else None,
+                'finished_at': self.finished_at.strftime(fmt) if self.finished_at else None,
+                'duration_ms': self.duration_ms(), 'processed': self.processed, 'total': self.total,
+                'message': self.message, 'error': self.error}
+
+    def save(self):
+        """Écrit l'état courant dans la table jobs"""
+        d = self.to_dict()
+        try:
+            conn = get_connection()
+            if self.id is None:
+                cursor = conn.execute('''INSERT INTO jobs (job_type, job_key, state, created_at, processed, total, message)
+                                        VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                                      (self.job_type, self.key, self.state, d['created_at'],
+                                       self.processed, self.total, self.message))
+                self.id = cursor.lastrowid
+            else:
+                conn.execute('''UPDATE jobs SET state = ?, started_at = ?, finished_at = ?, duration_ms = ?,
+                                processed = ?, total = ?, message = ?, error = ? WHERE id = ?''',
+                             (self.state, d['started_at'], d['finished_at'], d['duration_ms'],
+                              self.processed, self.total, self.message, self.error, self.id))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"DEBUG jobs: Erreur sauvegarde job {self.key} = {e}")
+
+class JobManager:
+    """Lance les jobs de fond avec déduplication par clé et capacité globale bornée"""
+
+    def __init__(self, max_concurrent):
+        self.lock = threading.Lock()
+        self.capacity = threading.BoundedSemaphore(max_concurrent)
+        self.active = {}
+
+    def submit(self, job_type, key, target, priority='user'):
+        """Démarre `target(job)` en arrière-plan, ou retourne le job déjà actif pour `key`.
+
+        `priority` : priorité de ses appels fournisseurs (user, cron, analysis).
+        Retourne (job, attached) : attached est vrai si l'appel s'est rattaché
+        à un job existant.
+        """
+        with self.lock:
+            job = self.active.get(key)
+            if job is not None:
+                return job, True
+            job = Job(job_type, key)
+            self.active[key] = job
+        job.save()
+        thread = threading.Thread(target=self.run, args=(job, with_priority(target, priority)), name=f"job-{key}")
+        thread.daemon = True
+        thread.start()
+        return job, False
+
+    def run(self, job, target):
+        try:
+            # Attendre une place libre (état 'queued' jusque-là)
+            with self.capacity:
+                job.state = 'running'
+                job.started_at = datetime.now()
+                job.save()
+                try:
+                    target(job)
+                    job.state = 'done'
+                except Exception as e:
+                    # Annuler ce que le job aurait laissé non validé sur la connexion du thread
+                    conn = getattr(db_local, 'conn', None)
+                    if conn is not None:
+                        conn.release()
+                    job.state = 'failed'
+                    job.error = str(e)
+                    print(f"DEBUG jobs: Job {job.key} en échec = {e}")
+                job.finished_at = datetime.now()
+                job.save()
+                print(f"DEBUG jobs: Job {job.key} {job.state} en {job.duration_ms()} ms")
+        finally:
+            with self.lock:
+                if self.active.get(job.key) is job:
+                    del self.active[job.key]
+            job.done.set()
+
+    def get(self, key):
+        with self.lock:
+            return self.active.get(key)
+
+    def list_active(self):
+        with self.lock:
+            return list(self.active.values())
+
+JOBS = JobManager(JOB_MAX_CONCURRENT)
+
+def job_response(job, attached, message):
+    """Réponse JSON commune des routes qui déclenchent un job"""
+    if attached:
+        message = f"Déjà en cours ({job.processed}/{job.total}) : rattaché au job existant"
+    return jsonify({'success': True, 'message': message, 'job': job.to_dict(), 'attached': attached})
+
+# --- RÉPONSES CONDITIONNELLES (ETag / Last-Modified) ---
+def conditional_json(scopes, build):
+    """Réponse JSON validée par les versions de données des `scopes`.
+
+    L'ETag combine les versions, l'utilisateur et l'URL complète (paramètres
+    inclus) ; Last-Modified est la dernière mise à jour des scopes. Si le client
+    a déjà cette version, on répond 304 sans appeler `build()`. Les erreurs de
+    `build()` doivent porter un statut non 2xx : elles partent sans validateurs.
+    """
+    conn = get_connection()
+    rows = conn.execute('''SELECT scope, version, updated_at FROM data_versions 
+                           WHERE scope IN (SELECT value FROM json_each(?))''', (json.dumps(scopes),)).fetchall()
+    conn.close()
+    versions = {row['scope']: row for row in rows}
+    source = '|'.join(f"{scope}={versions[scope]['version'] if scope in versions else 0}" for scope in scopes)
+    etag = hashlib.sha1(f"{session.get('user_id')}|{request.full_path}|{source}".encode('utf-8')).hexdigest()[:24]
+    last_modified = max((datetime.strptime(row['updated_at'], '%Y-%m-%d %H:%M:%S') for row in rows), default=None)
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = bool(last_modified and request.if_modified_since
+                            and request.if_modified_since.replace(tzinfo=None) >= last_modified)
+    response = Response(status=304) if not_modified else build()
+    if isinstance(response, tuple):
+        return response  # Erreur (statut explicite) : pas de validateurs
+    # Validateurs sur les réponses réussies seulement : une erreur ne doit pas être revalidée en 304
+    if response.status_code != 304 and not 200 <= response.status_code < 300:
+        return response
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    # Le navigateur garde la réponse mais revalide à chaque visite
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 # --- ROUTES ---
 @app.route('/')
@@ -643,6 +2187,7 @@ def fix_franklin():
                             prix_actuel = 37.5, 
                             prix_veille = 37.0 
                         WHERE id = ?''', (franklin['id'],))
+        refresh_portfolio_summary(conn, session['user_id'])
         conn.commit()
         conn.close()
         
@@ -679,7 +2224,13 @@ def api_fix_ticker():
             new_ticker = normalize_forced_symbol(nom)
             if new_ticker == nom:
                 new_ticker = old_ticker  # Pas de changement
-        
+
+        # Sinon, reprendre le symbole déjà résolu (table symbol_resolution, sans appel réseau)
+        if new_ticker == old_ticker:
+            cached = get_cached_resolution(old_ticker, max_age=None)
+            if cached and cached['symbol'] and cached['symbol'].upper() != old_ticker.upper():
+                new_ticker = cached['symbol']
+
         if new_ticker != old_ticker and new_ticker != nom:
             conn.execute('UPDATE actifs SET ticker_isin = ? WHERE id = ?', (new_ticker, a['id']))
             fixed.append({'id': a['id'], 'nom': a['nom_actif'], 'old': old_ticker, 'new': new_ticker})
@@ -699,6 +2250,40 @@ def api_fix_ticker():
     
     return jsonify({'fixed': fixed, 'all_actifs': diag})
 
+@app.route('/api/unresolved_tickers')
+def api_unresolved_tickers():
+    """Diagnostic du cache négatif : identifiants introuvables et positions concernées"""
+    token = request.args.get('token')
+    if token != CRON_TOKEN:
+        return jsonify({'error': 'Non autorisé'}), 401
+
+    # ?clear=IDENTIFIANT (ou ?clear=all) pour forcer un nouvel essai
+    to_clear = (request.args.get('clear') or '').strip()
+    conn = get_connection()
+    if to_clear:
+        if to_clear.lower() == 'all':
+            conn.execute('DELETE FROM lookup_failures')
+        else:
+            conn.execute('DELETE FROM lookup_failures WHERE identifier = ?', (to_clear.upper(),))
+        conn.commit()
+
+    failures = conn.execute('SELECT * FROM lookup_failures ORDER BY failures DESC, identifier').fetchall()
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    diag = []
+    for f in failures:
+        positions = conn.execute('''SELECT a.id, a.nom_actif, a.ticker_isin, c.user_id
+                                    FROM actifs a
+                                    JOIN comptes c ON a.compte_id = c.id
+                                    WHERE UPPER(TRIM(a.ticker_isin)) = ?''', (f['identifier'],)).fetchall()
+        diag.append({'identifier': f['identifier'], 'failures': f['failures'],
+                     'first_failure': f['first_failure'], 'last_failure': f['last_failure'],
+                     'retry_after': f['retry_after'], 'in_backoff': f['retry_after'] > now,
+                     'positions': [dict(p) for p in positions]})
+    conn.close()
+
+    return jsonify({'count': len(diag), 'unresolved': diag,
+                    'providers': [client.status() for client in PROVIDERS.values()]})
+
 @app.route('/fix_all_currencies')
 def fix_all_currencies():
     """Force toutes les actions sauf Hays en EUR"""
@@ -732,6 +2317,7 @@ def fix_all_currencies():
                        WHERE c.user_id = ? AND UPPER(a.ticker_isin) NOT LIKE '%HAYS%'
                    )''', (session['user_id'],))
     
+    refresh_portfolio_summary(conn, session['user_id'])
     conn.commit()
     conn.close()
     print("Toutes les devises corrigées: Hays=GBP, reste=EUR")
@@ -768,102 +2354,21 @@ def dashboard():
         user_devise = user_info['devise'] if user_info and user_info['devise'] else 'EUR'
         currency_symbol = CURRENCY_SYMBOLS.get(user_devise, '€')
         
-        # Calculer le mois actuel
-        from datetime import datetime
-        mois_actuel = datetime.now().strftime("%Y-%m")
-        
-        total_achat = 0
-        total_actuel = 0
-        total_pv = 0
-        total_day_pv = 0
-        total_month_pv = 0
-        comptes_stats = {}
-        
+        # Totaux précalculés (portfolio_summary / compte_summary), recalculés si absents
+        summary = load_portfolio_summary(conn, session['user_id'])
+        comptes_stats = summary['comptes_stats']
         for c in comptes:
-            comptes_stats[c['id']] = {'achat': 0, 'actuel': 0, 'pv': 0, 'day_pv': 0}
-
-        # Pour trouver les top/bottom performers du jour
-        day_performances = []
-        
-        for a in actifs:
-            p_actuel = safe_float(a['prix_actuel'])
-            p_achat = safe_float(a['prix_achat'])
-            p_veille = safe_float(a['prix_veille'])
-            
-            qty = safe_int(a['quantite'])
-            frais = safe_float(a['frais'])
-            try:
-                devise_cotation = a['devise_cotation'] or 'EUR'
-            except (KeyError, IndexError):
-                devise_cotation = 'EUR'
-            
-            # Calculer les valeurs dans la devise de cotation
-            val_actuelle = (p_actuel * qty) + frais
-            val_achat = (p_achat * qty) + frais
-            val_veille = (p_veille * qty) + frais
-            
-            pv = val_actuelle - val_achat
-            
-            # PV du jour : détecter si prix_veille est aberrant
-            # Si prix_veille est trop éloigné du prix actuel (> 20% d'écart), utiliser prix_achat
-            if p_veille == 0 or abs(p_veille - p_actuel) > (p_actuel * 0.20):
-                # Prix de veille aberrant : calculer par rapport au prix d'achat
-                day_pv = val_actuelle - val_achat
-            else:
-                # Prix de veille normal : calculer la variation du jour
-                day_pv = val_actuelle - val_veille
-            
-            # Convertir vers EUR pour les totaux (devise de référence)
-            val_actuelle_eur = convert_currency(val_actuelle, devise_cotation, 'EUR')
-            val_achat_eur = convert_currency(val_achat, devise_cotation, 'EUR')
-            pv_eur = convert_currency(pv, devise_cotation, 'EUR')
-            day_pv_eur = convert_currency(day_pv, devise_cotation, 'EUR')
-            
-            # Récupérer le cumul du mois depuis la table dédiée
-            # IMPORTANT : Afficher SEULEMENT le cumul (PAS la PV du jour en cours)
-            # Le cumul sera mis à jour à 17h45 par le CRON
-            cumul_mois_row = conn.execute(
-                'SELECT cumul_pv FROM cumul_pv_mois WHERE actif_id = ? AND mois = ?',
-                (a['id'], mois_actuel)
-            ).fetchone()
-            
-            if cumul_mois_row:
-                month_pv_eur = safe_float(cumul_mois_row['cumul_pv'])
-            else:
-                # Pas encore de cumul pour ce mois : afficher 0
-                month_pv_eur = 0
-            
-            # Calcul de la variation journalière en %
-            if p_veille > 0:
-                day_perf_pct = ((p_actuel - p_veille) / p_veille) * 100
-                day_performances.append({'nom': a['nom_actif'], 'perf': day_perf_pct})
-            
-            # Additionner en EUR
-            total_achat += val_achat_eur
-            total_actuel += val_actuelle_eur
-            total_pv += pv_eur
-            total_day_pv += day_pv_eur
-            total_month_pv += month_pv_eur
-            
-            if a['compte_id'] in comptes_stats:
-                comptes_stats[a['compte_id']]['achat'] += val_achat_eur
-                comptes_stats[a['compte_id']]['actuel'] += val_actuelle_eur
-                comptes_stats[a['compte_id']]['pv'] += pv_eur
-                comptes_stats[a['compte_id']]['day_pv'] += day_pv_eur
-        
-        # Trouver les top/bottom performers
-        top_gainer = max(day_performances, key=lambda x: x['perf']) if day_performances else None
-        top_loser = min(day_performances, key=lambda x: x['perf']) if day_performances else None
+            comptes_stats.setdefault(c['id'], {'achat': 0, 'actuel': 0, 'pv': 0, 'day_pv': 0})
         
         conn.close()
         
         return render_template('dashboard.html', comptes=comptes, actifs=actifs,
-                              user_nom=session.get('user_nom'), total_pv=total_pv,
-                              total_achat=total_achat, total_actuel=total_actuel,
-                              total_day_pv=total_day_pv, total_month_pv=total_month_pv,
+                              user_nom=session.get('user_nom'), total_pv=summary['total_pv'],
+                              total_achat=summary['total_achat'], total_actuel=summary['total_actuel'],
+                              total_day_pv=summary['total_day_pv'], total_month_pv=summary['total_month_pv'],
                               derniere_maj=derniere_maj,
                               comptes_stats=comptes_stats,
-                              top_gainer=top_gainer, top_loser=top_loser,
+                              top_gainer=summary['top_gainer'], top_loser=summary['top_loser'],
                               user_devise=user_devise, currency_symbol=currency_symbol)
     except Exception as e:
         return f"Erreur Dashboard: {e}"
@@ -906,6 +2411,7 @@ def add_actif():
     # Initialiser le cumul du mois à 0 pour ce nouvel actif
     conn.execute('INSERT INTO cumul_pv_mois (actif_id, mois, cumul_pv, derniere_mise_a_jour) VALUES (?, ?, 0, ?)',
                 (actif_id, mois_actuel, date_actuelle))
+    refresh_portfolio_summary(conn, session['user_id'])
     
     conn.commit()
     conn.close()
@@ -930,6 +2436,7 @@ def update_actif(actif_id):
     # Les prix sont déjà dans la devise de cotation de l'actif, pas besoin de conversion
     conn.execute('UPDATE actifs SET nom_actif=?, prix_achat=?, quantite=?, frais=?, prix_actuel=?, date_achat=? WHERE id=?',
                 (nom, pa, q, fr, pnow, date_achat, actif_id))
+    refresh_portfolio_summary(conn, session['user_id'])
     conn.commit()
     conn.close()
     return redirect(url_for('dashboard'))
@@ -939,6 +2446,7 @@ def delete_actif(actif_id):
     if 'user_id' not in session: return redirect(url_for('index'))
     conn = get_connection()
     conn.execute('DELETE FROM actifs WHERE id = ?', (actif_id,))
+    refresh_portfolio_summary(conn, session['user_id'])
     conn.commit()
     conn.close()
     return redirect(url_for('dashboard'))
@@ -949,13 +2457,15 @@ def delete_compte(compte_id):
     conn = get_connection()
     conn.execute('DELETE FROM actifs WHERE compte_id = ?', (compte_id,))
     conn.execute('DELETE FROM comptes WHERE id = ?', (compte_id,))
+    refresh_portfolio_summary(conn, session['user_id'])
     conn.commit()
     conn.close()
     return redirect(url_for('dashboard'))
 
 @app.route('/api/search_ticker/<ticker>')
 def search_ticker(ticker):
-    price, name, prev_close, currency = fetch_price_from_api(ticker)
+    # Recherche interactive : on retente même un identifiant en backoff
+    price, name, prev_close, currency = fetch_price_from_api(ticker, ignore_backoff=True)
     return jsonify({'price': price, 'name': name, 'prev_close': prev_close, 'currency': currency})
 
 # Cache global pour l'analyse
@@ -964,83 +2474,158 @@ conseil_cache = {
     'timestamp': None
 }
 
-import concurrent.futures
+def analysis_symbol(ticker):
+    """Normalisation du ticker : Ajouter .PA si pas de suffixe (pour Euronext Paris par défaut)"""
+    search_ticker = ticker
+    if '.' not in search_ticker and not search_ticker.isdigit() and not search_ticker.endswith('.BR'):
+         search_ticker = f"{search_ticker}.PA"
+    return search_ticker
+
+# Re-scoring complet forcé au-delà de ce délai (les news sortent de la fenêtre de 10 jours)
+ANALYSIS_FULL_REFRESH = timedelta(hours=safe_int(os.environ.get('ANALYSIS_FULL_REFRESH_HOURS'), 24))
+
+def utc_now_iso():
+    """Horodatage UTC au format des dates de news EODHD (2025-05-06T10:32:49+00:00)"""
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S+00:00')
 
-def analyze_ticker(ticker, api_key, base_url, realtime_url, ticker_names):
-    """Analyse un seul ticker (exécuté en parallèle)"""
+def score_is_fresh(state):
+    """Vrai si le score stocké date de moins de ANALYSIS_FULL_REFRESH"""
+    if not state or not state['last_scored_at']:
+        return False
+    try:
+        scored_at = datetime.strptime(state['last_scored_at'][:19], '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return False
+    return datetime.utcnow() - scored_at < ANALYSIS_FULL_REFRESH
+
+# --- NEWS : STOCKAGE LOCAL ET SENTIMENT ---
+# Fenêtre de fraîcheur des news (jours) et demi-vie de la pondération temporelle
+NEWS_WINDOW_DAYS = safe_int(os.environ.get('NEWS_WINDOW_DAYS'), 10)
+NEWS_HALF_LIFE_DAYS = safe_float(os.environ.get('NEWS_HALF_LIFE_DAYS'), 3.0)
+# Au-delà, les news stockées sont purgées
+NEWS_RETENTION_DAYS = safe_int(os.environ.get('NEWS_RETENTION_DAYS'), 90)
+
+def store_news(conn, ticker, items):
+    """Enregistre les news EODHD d'un ticker (doublons ignorés via le hash du lien) -> nb de news nouvelles"""
+    rows = []
+    for item in items:
+        if not isinstance(item, dict) or not item.get("date"):
+            continue
+        sentiment = item.get("sentiment") or {}
+        key = item.get("link") or f'{item["date"]}|{item.get("title", "")}'
+        rows.append((ticker, hashlib.sha1(key.encode('utf-8')).hexdigest(), item["date"],
+                     sentiment.get("polarity"), item.get("title")))
+    return conn.executemany('''INSERT OR IGNORE INTO news_items (ticker, link_hash, published_at, polarity, title)
+                               VALUES (?, ?, ?, ?, ?)''', rows).rowcount
+
+def news_sentiment(conn, ticker, window_days=None, half_life_days=None, now=None):
+    """Score de sentiment pondéré par l'ancienneté des news stockées.
+
+    Retourne (score, nb_news) ; score vaut 0.5 (neutre) sans news dans la fenêtre.
+    """
+    window_days = NEWS_WINDOW_DAYS if window_days is None else window_days
+    half_life_days = NEWS_HALF_LIFE_DAYS if half_life_days is None else half_life_days
+    now = now or datetime.utcnow()
+    # Même tolérance qu'avant sur les dates dans le futur (-2 jours)
+    since = (now - timedelta(days=window_days + 1)).strftime('%Y-%m-%d')
+    until = (now + timedelta(days=3)).strftime('%Y-%m-%d')
+    rows = conn.execute('''SELECT published_at, polarity FROM news_items 
+                           WHERE ticker = ? AND polarity IS NOT NULL 
+                           AND published_at >= ? AND published_at < ?''',
+                        (ticker, since, until)).fetchall()
+    total = weights = 0.0
+    nb_news = 0
+    for row in rows:
+        try:
+            published = datetime.strptime(row['published_at'][:10], "%Y-%m-%d")
+        except ValueError:
+            continue
+        age_days = (now - published).days
+        if age_days > window_days or age_days < -2:
+            continue
+        weight = 0.5 ** (max(age_days, 0) / half_life_days) if half_life_days > 0 else 1.0
+        total += weight * row['polarity']
+        weights += weight
+        nb_news += 1
+    if not nb_news:
+        return 0.5, 0
+    return total / weights, nb_news
+
+def sentiment_signal(score, nb_news):
+    """Signal d'achat/vente à partir du score de sentiment -> (score, signal, signal_class)"""
+    if nb_news == 0:
+        return 0.5, "⚪ PAS DE NEWS", "signal-neutre"  # Force neutre
+    if score >= 0.5:
+        return score, "🟢 ACHAT", "signal-achat"
+    if score < 0.0:
+        return score, "🔴 VENTE", "signal-vente"
+    return score, "🟡 NEUTRE", "signal-neutre"
+
+def rescore_market_analysis(conn, window_days=None, half_life_days=None):
+    """Recalcule score et signal de market_analysis depuis les news stockées (aucun appel HTTP)"""
+    updates = []
+    for row in conn.execute('SELECT ticker FROM market_analysis').fetchall():
+        score, nb_news = news_sentiment(conn, row['ticker'], window_days, half_life_days)
+        score, signal, signal_class = sentiment_signal(score, nb_news)
+        updates.append((score, nb_news, signal, signal_class, row['ticker']))
+    conn.executemany('UPDATE market_analysis SET score = ?, nb_news = ?, signal = ?, signal_class = ? WHERE ticker = ?',
+                     updates)
+    bump_data_version(conn, 'market_analysis')
+    return len(updates)
+
+def analyze_ticker(ticker, api_key, base_url, realtime_url, ticker_names, prices=None, state=None, force=False):
+    """Analyse un seul ticker (exécuté en parallèle) ; `prices` : cotations groupées déjà récupérées.
+
+    Un seul appel news par ticker, à partir de la dernière news vue (`state`).
+    Sans news nouvelle et avec un score encore frais, retourne
+    {'ticker', 'unchanged': True, 'price'} : la ligne existante est conservée.
+    """
     try:
-        # Normalisation du ticker : Ajouter .PA si pas de suffixe (pour Euronext Paris par défaut)
-        search_ticker = ticker
-        if '.' not in search_ticker and not search_ticker.isdigit() and not search_ticker.endswith('.BR'):
-             search_ticker = f"{search_ticker}.PA"
+        search_ticker = analysis_symbol(ticker)
              
-        # 1. Sentiment (News)
-        score = 0.5  # Neutre par défaut
-        nb_news = 0
-        sentiments = []
-        
+        # 1. Sentiment (News) : on stocke les nouvelles news puis on score depuis la base
+        latest_news_at = None
+        inserted = None
+        conn = get_connection()
         try:
-            params = {"s": search_ticker, "limit": 10, "api_token": api_key, "fmt": "json"}
-            resp = requests.get(base_url, params=params, timeout=3).json()
-            
-            if isinstance(resp, list):
-                # Filtrer les news trop vieilles (> 30 jours)
-                # Format date API: "2025-05-06T10:32:49+00:00"
-                current_date = datetime.now()
-                valid_sentiments = []
-                
-                for item in resp:
-                    if isinstance(item, dict) and item.get("sentiment") and item["sentiment"].get("polarity") is not None:
-                        date_str = item.get("date", "")
-                        try:
-                            # Tenter de parser la date (format ISO simple)
-                            if date_str:
-                                news_date = datetime.strptime(date_str.split('T')[0], "%Y-%m-%d")
-                                delta = current_date - news_date
-                                # Si la news a plus de 10 jours, on l'ignore (news fraiches uniquement)
-                                if delta.days > 10 or delta.days < -2:
-                                    continue
-                        except:
-                            pass # Si erreur de date, on garde par prudence ou on jette ? Gardons pour l'instant.
-                            
-                        valid_sentiments.append(item["sentiment"]["polarity"])
+            try:
+                params = {"s": search_ticker, "limit": 10, "api_token": api_key, "fmt": "json"}
+                if state and state['last_news_at'] and not force:
+                    params["from"] = state['last_news_at'][:10]
+                resp = EODHD.get(base_url, params=params, cost=EODHD_COST_NEWS).json()
                 
-                if valid_sentiments:
-                    score = sum(valid_sentiments) / len(valid_sentiments)
-                    nb_news = len(valid_sentiments)
-                else:
-                    # Aucune news récente valide
-                    nb_news = 0
-                    
-        except Exception as e:
-            print(f"Erreur sentiment {ticker}: {e}")
+                if isinstance(resp, list):
+                    # Date de la news la plus récente vue (point de départ du prochain passage)
+                    dates = [item.get("date") for item in resp if isinstance(item, dict) and item.get("date")]
+                    latest_news_at = max(dates) if dates else None
+                    inserted = store_news(conn, ticker, resp)
+                    conn.commit()
+            except Exception as e:
+                print(f"Erreur sentiment {ticker}: {e}")
+
+            # Rien de nouveau depuis le dernier score : pas de re-scoring ni d'appel prix unitaire
+            if inserted == 0 and not force and score_is_fresh(state):
+                return {"ticker": ticker, "unchanged": True, "latest_news_at": latest_news_at,
+                        "price": (prices or {}).get(search_ticker.upper(), (None,))[0]}
+
+            score, nb_news = news_sentiment(conn, ticker)
+        finally:
+            conn.close()
 
-        # 2. Prix actuel
-        price = None
-        try:
-            price_resp = requests.get(f"{realtime_url}/{search_ticker}", 
-                                     params={"api_token": api_key, "fmt": "json"}, 
-                                     timeout=3)
-            price_data = price_resp.json()
-            if 'close' in price_data and price_data['close'] not in ['NA', 'N/A', None, '']:
-                price = float(price_data['close'])
-        except Exception as e:
-            print(f"Erreur prix {ticker}: {e}")
+        # 2. Prix actuel (cotation groupée si disponible, sinon appel unitaire)
+        price = (prices or {}).get(search_ticker.upper(), (None,))[0]
+        if price is None:
+            try:
+                price_resp = EODHD.get(f"{realtime_url}/{search_ticker}",
+                                       params={"api_token": api_key, "fmt": "json"})
+                price_data = price_resp.json()
+                if 'close' in price_data and price_data['close'] not in ['NA', 'N/A', None, '']:
+                    price = float(price_data['close'])
+            except Exception as e:
+                print(f"Erreur prix {ticker}: {e}")
         
         # 4. Signal
-        if nb_news == 0:
-            signal = "⚪ PAS DE NEWS"
-            signal_class = "signal-neutre"
-            score = 0.5 # Force neutre
-        elif score >= 0.5:
-            signal = "🟢 ACHAT"
-            signal_class = "signal-achat"
-        elif score < 0.0:
-            signal = "🔴 VENTE"
-            signal_class = "signal-vente"
-        else:
-            signal = "🟡 NEUTRE"
-            signal_class = "signal-neutre"
+        score, signal, signal_class = sentiment_signal(score, nb_news)
         
         return {
             "ticker": ticker, 
@@ -1049,36 +2634,93 @@ def analyze_ticker(ticker, api_key, base_url, realtime_url, ticker_names):
             "nb_news": nb_news,
             "signal": signal,
             "signal_class": signal_class,
-            "price": price
+            "price": price,
+            "latest_news_at": latest_news_at
         }
     except Exception as e:
         print(f"Erreur thread global {ticker}: {e}")
     return None
 
+# --- BOUGIES EOD : STOCKAGE LOCAL ---
+# Profondeur du premier téléchargement d'un symbole (jours calendaires)
+EOD_BOOTSTRAP_DAYS = safe_int(os.environ.get('EOD_BOOTSTRAP_DAYS'), 25)
+
+def eod_value(candle, field):
+    """Valeur numérique d'une bougie EODHD (None si absente)"""
+    try:
+        value = candle.get(field)
+        return float(value) if value not in (None, '', 'NA', 'N/A') else None
+    except (TypeError, ValueError):
+        return None
+
+def sync_eod_candles(conn, symbol, api_key, bootstrap_days=None):
+    """Complète eod_candles pour un symbole depuis la dernière date stockée.
+
+    La dernière bougie est re-téléchargée (elle peut avoir été prise en séance).
+    Le premier remplissage est mémorisé (eod_candles_state) : un symbole dont le
+    fournisseur a moins d'historique que demandé passe ensuite en incrémental.
+    Retourne le nombre de bougies reçues.
+    """
+    row = conn.execute('''SELECT MIN(c.date) AS first, MAX(c.date) AS last, 
+                                  (SELECT bootstrap_from FROM eod_candles_state WHERE symbol = ?) AS bootstrap_from 
+                           FROM eod_candles c WHERE c.symbol = ?''', (symbol, symbol)).fetchone()
+    days = EOD_BOOTSTRAP_DAYS if bootstrap_days is None else bootstrap_days
+    wanted_start = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+    backfill_limit = (datetime.now() - timedelta(days=days - 7)).strftime("%Y-%m-%d")
+    if row['last'] and min(row['first'], row['bootstrap_from'] or row['first']) <= backfill_limit:
+        start_date = row['last']
+    else:
+        # Premier passage, ou historique stocké trop court pour la profondeur demandée
+        start_date = wanted_start
+    data = EODHD.get(f"{EODHD_API_URL}/eod/{symbol}",
+                     params={"from": start_date, "api_token": api_key, "fmt": "json"}).json()
+    if not isinstance(data, list):
+        return 0
+    rows = [(symbol, c['date'], eod_value(c, 'open'), eod_value(c, 'high'), eod_value(c, 'low'),
+             eod_value(c, 'close'), eod_value(c, 'adjusted_close'), eod_value(c, 'volume'))
+            for c in data if isinstance(c, dict) and c.get('date') and eod_value(c, 'close') is not None]
+    conn.executemany('''INSERT INTO eod_candles (symbol, date, open, high, low, close, adjusted_close, volume)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(symbol, date) DO UPDATE SET 
+                            open = excluded.open, high = excluded.high, low = excluded.low, 
+                            close = excluded.close, adjusted_close = excluded.adjusted_close, 
+                            volume = excluded.volume''', rows)
+    if start_date == wanted_start and rows:
+        # Historique demandé jusqu'à wanted_start : ce que le fournisseur n'a pas n'existe pas
+        conn.execute('''INSERT INTO eod_candles_state (symbol, bootstrap_from) VALUES (?, ?) 
+                        ON CONFLICT(symbol) DO UPDATE SET bootstrap_from = MIN(bootstrap_from, excluded.bootstrap_from)''',
+                     (symbol, wanted_start))
+    return len(rows)
+
+def load_eod_candles(conn, symbol, limit=30):
+    """Dernières bougies stockées d'un symbole, de la plus ancienne à la plus récente"""
+    rows = conn.execute('''SELECT * FROM (SELECT * FROM eod_candles WHERE symbol = ? 
+                                           ORDER BY date DESC LIMIT ?) ORDER BY date''',
+                        (symbol, limit)).fetchall()
+    return [dict(r) for r in rows]
+
 def analyze_etf_trend(ticker, api_key, realtime_url, ticker_names):
     """Analyse technique ETF : Tendance sur 15 jours"""
     try:
-        from datetime import timedelta
         # Récupérer les métadonnées manuelles
         meta = ETF_METADATA.get(ticker, (ticker_names.get(ticker, ticker), "N/A", "ETF"))
         name, expense, category = meta[0], meta[1], meta[2]
         
-        # 1. Récupérer l'historique récent (20 jours pour être large avec les weekends)
-        today = datetime.now()
-        start_date = (today - timedelta(days=25)).strftime("%Y-%m-%d")
-        
-        hist_url = f"https://eodhd.com/api/eod/{ticker}"
-        params = {
-            "from": start_date,
-            "api_token": api_key,
-            "fmt": "json"
-        }
+        # 1. Compléter l'historique local puis lire les ~20 dernières séances
+        conn = get_connection()
+        try:
+            try:
+                sync_eod_candles(conn, ticker, api_key)
+                conn.commit()
+            except Exception as e:
+                # On calcule quand même sur les bougies déjà stockées
+                print(f"Erreur historique ETF {ticker}: {e}")
+            data = load_eod_candles(conn, ticker, limit=20)
+        finally:
+            conn.close()
         
         try:
-            resp = requests.get(hist_url, params=params, timeout=5)
-            data = resp.json()
-            
-            if isinstance(data, list) and len(data) > 10:
+            if len(data) > 10:
                 # Prix actuel (le dernier de la liste)
                 last_candle = data[-1]
                 price = float(last_candle['close'])
@@ -1149,6 +2791,102 @@ def analyze_etf_trend(ticker, api_key, realtime_url, ticker_names):
         print(f"Erreur analyze_etf_trend {ticker}: {e}")
     return None
 
+# --- INDICATEURS TECHNIQUES (VECTORISÉS) ---
+# Profondeur d'historique (jours calendaires) nécessaire aux indicateurs ETF (SMA 50, momentum 60 séances)
+ETF_LOOKBACK_DAYS = safe_int(os.environ.get('ETF_LOOKBACK_DAYS'), 120)
+INDICATOR_SESSIONS = 80
+TREND_SESSIONS = 10  # ~15 jours calendaires
+MOMENTUM_SESSIONS = 60
+VOLATILITY_SESSIONS = 20
+
+def load_price_matrix(np, conn, symbols, sessions=INDICATOR_SESSIONS):
+    """Matrice des clôtures (symboles x séances) sur les dernières dates connues.
+
+    Les trous (jours fériés propres à une place) sont comblés par la dernière
+    clôture connue ; les séances antérieures au premier cours restent NaN.
+    """
+    cutoff = (datetime.now() - timedelta(days=ETF_LOOKBACK_DAYS + 30)).strftime("%Y-%m-%d")
+    rows = conn.execute('''SELECT symbol, date, close FROM eod_candles 
+                           WHERE symbol IN (SELECT value FROM json_each(?)) AND date >= ?''',
+                        (json.dumps(symbols), cutoff)).fetchall()
+    dates = sorted({r['date'] for r in rows})[-sessions:]
+    date_index = {d: i for i, d in enumerate(dates)}
+    symbol_index = {s: i for i, s in enumerate(symbols)}
+    matrix = np.full((len(symbols), len(dates)), np.nan)
+    for r in rows:
+        col = date_index.get(r['date'])
+        if col is not None:
+            matrix[symbol_index[r['symbol']], col] = r['close']
+    return forward_fill(np, matrix), (~np.isnan(matrix)).sum(axis=1)
+
+def forward_fill(np, matrix):
+    """Comble les NaN de chaque ligne par la dernière valeur connue (NaN avant la première)"""
+    valid = ~np.isnan(matrix)
+    last_valid = np.where(valid, np.arange(matrix.shape[1]), 0)
+    np.maximum.accumulate(last_valid, axis=1, out=last_valid)
+    filled = matrix[np.arange(matrix.shape[0])[:, None], last_valid]
+    filled[np.cumsum(valid, axis=1) == 0] = np.nan
+    return filled
+
+def compute_indicators(np, closes):
+    """Indicateurs de tout l'univers en une passe (une ligne par symbole, en %)"""
+    def past(n):
+        # Clôture n séances avant la dernière (ou la plus ancienne disponible)
+        return closes[:, max(closes.shape[1] - 1 - n, 0)]
+
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        price = closes[:, -1]
+        returns = np.diff(np.log(closes), axis=1)
+        running_max = np.fmax.accumulate(closes, axis=1)
+        return {
+            'price': price,
+            'day_change_pct': (price / past(1) - 1) * 100,
+            'trend_15d_pct': (price / past(TREND_SESSIONS) - 1) * 100,
+            'sma_20': np.nanmean(closes[:, -20:], axis=1),
+            'sma_50': np.nanmean(closes[:, -50:], axis=1),
+            'volatility_pct': np.nanstd(returns[:, -VOLATILITY_SESSIONS:], axis=1, ddof=1) * np.sqrt(252) * 100,
+            'max_drawdown_pct': np.nanmin(closes / running_max - 1, axis=1) * 100,
+            'momentum_pct': (price / past(MOMENTUM_SESSIONS) - 1) * 100,
+        }
+
+def trend_signals(np, trend):
+    """Échelle de scores de tendance appliquée à tout le vecteur -> (scores, signaux, classes)"""
+    conditions = [trend > 2.0, trend > 0.5, trend < -2.0, trend < -0.5]
+    scores = np.select(conditions, [0.9, 0.7, 0.1, 0.3], 0.5)
+    labels = np.select(conditions, ["🟢 TENDANCE FORTE (+{:.1f}%)", "🟢 HAUSSE (+{:.1f}%)",
+                                    "🔴 BAISSE FORTE ({:.1f}%)", "🔴 BAISSE ({:.1f}%)"], "⚪ STABLE ({:.1f}%)")
+    classes = np.select(conditions, ["signal-achat", "signal-achat", "signal-vente", "signal-vente"], "signal-neutre")
+    return scores, [label.format(t) for label, t in zip(labels, trend)], classes
+
+def analyze_etf_universe(np, conn, symbols, ticker_names):
+    """Analyse de tous les ETF à partir des bougies stockées (moteur vectorisé NumPy)"""
+    closes, counts = load_price_matrix(np, conn, symbols)
+    if closes.shape[1] < 2:
+        return []
+    indicators = compute_indicators(np, closes)
+    scores, signals, classes = trend_signals(np, indicators['trend_15d_pct'])
+    # Même exigence qu'avant : plus de 10 séances pour une tendance fiable
+    keep = (counts > 10) & np.isfinite(indicators['trend_15d_pct']) & np.isfinite(indicators['day_change_pct'])
+    results = []
+    for i in np.flatnonzero(keep):
+        ticker = symbols[i]
+        name, expense, category = ETF_METADATA.get(ticker, (ticker_names.get(ticker, ticker), "N/A", "ETF"))[:3]
+        result = {
+            "ticker": ticker,
+            "name": name,
+            "score": float(scores[i]),
+            "nb_news": 15,
+            "signal": signals[i],
+            "signal_class": str(classes[i]),
+            "expense_ratio": expense,
+            "category": category,
+        }
+        for key, values in indicators.items():
+            result[key] = float(values[i]) if np.isfinite(values[i]) else None
+        results.append(result)
+    return results
+
 @app.route('/conseil-du-jour')
 def conseil_du_jour():
     """Affiche l'analyse de sentiment depuis la base de données"""
@@ -1191,12 +2929,27 @@ def update_market_analysis():
     if 'user_id' not in session and request.args.get('token') != CRON_TOKEN:
         return jsonify({'error': 'Non autorisé'}), 401
 
-    def run_update():
+    # ?full=1 : ignorer l'état incrémental et tout ré-analyser
+    force_full = request.args.get('full') == '1'
+
+    # ?rescore=1 : recalcul local depuis les news stockées (fenêtre ajustable via ?window=).
+    # Les scores sont partagés par tous les utilisateurs : réservé au chemin CRON
+    if request.args.get('rescore') == '1':
+        if request.args.get('token') != CRON_TOKEN:
+            return jsonify({'error': 'Non autorisé'}), 403
+        window = safe_int(request.args.get('window'), NEWS_WINDOW_DAYS)
+        conn = get_connection()
+        count = rescore_market_analysis(conn, window_days=window)
+        conn.commit()
+        conn.close()
+        return jsonify({'success': True, 'rescored': count, 'window_days': window})
+
+    def run_update(job):
         conn = get_connection()
         # Configuration API
         API_KEY = EODHD_API_KEY
-        BASE_URL = "https://eodhd.com/api/news"
-        REALTIME_API_URL = "https://eodhd.com/api/real-time"
+        BASE_URL = f"{EODHD_API_URL}/news"
+        REALTIME_API_URL = f"{EODHD_API_URL}/real-time"
         
         # Combiner SBF 120 + Actifs utilisateurs
         all_tickers = set(SBF120_TICKERS)
@@ -1213,63 +2966,107 @@ def update_market_analysis():
             pass
             
         final_list = list(all_tickers)
+        # Quota bas : l'analyse passe après les cotations, on garde l'instantané actuel
+        if not EODHD.ledger.allows(len(final_list) * EODHD_COST_NEWS):
+            conn.close()
+            job.update(message="Quota EODHD insuffisant : analyse reportée")
+            print("DEBUG quota: Analyse de marché reportée (quota EODHD réservé aux cotations)")
+            return
+        job.update(processed=0, total=len(final_list))
         print(f"DEBUG: Lancement analyse pour {len(final_list)} titres")
         
+        # État incrémental : seuls les titres déjà présents en base peuvent être sautés
+        existing = {row['ticker'] for row in conn.execute('SELECT ticker FROM market_analysis').fetchall()}
+        states = {row['ticker']: row for row in conn.execute('SELECT * FROM analysis_state').fetchall()}
+        
+        # Cotations de tout l'univers en quelques appels groupés (repli unitaire dans analyze_ticker)
+        prices = fetch_bulk_quotes(analysis_symbol(t) for t in final_list)
+        
         # Exécution parallèle optimisée pour 250 titres
         results_to_save = []
+        unchanged = []
         # Augmenter à 15 workers pour accélérer (EODHD supporte bien la concurrence)
         with concurrent.futures.ThreadPoolExecutor(max_workers=15) as executor:
             future_to_ticker = {
-                executor.submit(analyze_ticker, t, API_KEY, BASE_URL, REALTIME_API_URL, TICKER_NAMES_MAP): t 
+                executor.submit(with_priority(analyze_ticker), t, API_KEY, BASE_URL, REALTIME_API_URL, TICKER_NAMES_MAP,
+                                prices, states.get(t) if t in existing else None, force_full): t 
                 for t in final_list
             }
             for future in concurrent.futures.as_completed(future_to_ticker):
                 try:
                     res = future.result()
-                    if res:
+                    if res and res.get('unchanged'):
+                        unchanged.append(res)
+                    elif res:
                         results_to_save.append(res)
                 except Exception as e:
                     print(f"Erreur future: {e}")
+                job.update(processed=job.processed + 1)
         
         # Sauvegarde en base
         now = datetime.now().strftime('%d/%m/%Y à %H:%M')
+        run_at = utc_now_iso()
         
-        # Vider la table avant d'insérer (ou faire un upsert)
-        conn.execute('DELETE FROM market_analysis')
-        
-        for r in results_to_save:
-            conn.execute('''INSERT INTO market_analysis (ticker, name, score, nb_news, signal, signal_class, price, last_updated)
+        # Nouvel instantané en staging : lignes conservées (inchangées ou analyses en échec)
+        # + titres ré-analysés ; les titres sortis de l'univers disparaissent
+        staging = open_staging(conn, 'market_analysis',
+                               'ticker IN (SELECT value FROM json_each(?)) AND ticker NOT IN (SELECT value FROM json_each(?))',
+                               (json.dumps(final_list), json.dumps([r['ticker'] for r in results_to_save])))
+        conn.executemany(f'''INSERT INTO {staging} (ticker, name, score, nb_news, signal, signal_class, price, last_updated)
                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                         (r['ticker'], r['name'], r['score'], r['nb_news'], r['signal'], r['signal_class'], r['price'], now))
+                         [(r['ticker'], r['name'], r['score'], r['nb_news'], r['signal'], r['signal_class'], r['price'], now)
+                          for r in results_to_save])
+        # Titres inchangés : seul le prix (cotation groupée) est rafraîchi ; sans prix, la ligne
+        # garde sa date de mise à jour pour ne pas présenter un ancien cours comme frais
+        conn.executemany(f'UPDATE {staging} SET price = ?, last_updated = ? WHERE ticker = ?',
+                         [(r['price'], now, r['ticker']) for r in unchanged if r['price'] is not None])
+        publish_staged(conn, 'market_analysis')
+        
+        # Purger les news trop anciennes pour rester utiles au scoring
+        purge_before = (datetime.utcnow() - timedelta(days=NEWS_RETENTION_DAYS)).strftime('%Y-%m-%d')
+        conn.execute('DELETE FROM news_items WHERE published_at < ?', (purge_before,))
+        
+        # Mémoriser la dernière news vue par titre pour le prochain passage
+        conn.executemany('''INSERT INTO analysis_state (ticker, last_news_at, last_run_at, last_scored_at)
+                            VALUES (?, ?, ?, ?)
+                            ON CONFLICT(ticker) DO UPDATE SET 
+                                last_news_at = COALESCE(excluded.last_news_at, analysis_state.last_news_at),
+                                last_run_at = excluded.last_run_at,
+                                last_scored_at = excluded.last_scored_at''',
+                         [(r['ticker'], r.get('latest_news_at'), run_at, run_at) for r in results_to_save])
+        conn.executemany('UPDATE analysis_state SET last_run_at = ? WHERE ticker = ?',
+                         [(run_at, r['ticker']) for r in unchanged])
         
         conn.commit()
         conn.close()
-        print(f"DEBUG: Analyse terminée et sauvegardée ({len(results_to_save)} titres)")
+        job.update(message=f"{len(results_to_save)} titres ré-analysés, {len(unchanged)} inchangés")
+        print(f"DEBUG: Analyse terminée et sauvegardée ({len(results_to_save)} ré-analysés, {len(unchanged)} inchangés)")
 
-    # Lancer le thread
-    thread = threading.Thread(target=run_update)
-    thread.daemon = True
-    thread.start()
-    
-    return jsonify({'success': True, 'message': 'Analyse lancée en fond. Rafraichissez dans quelques minutes.'})
+    # Lancer le job (ou se rattacher à l'analyse déjà en cours)
+    job, attached = JOBS.submit('market_analysis', 'market_analysis', run_update, priority='analysis')
+    return job_response(job, attached, 'Analyse lancée en fond. Rafraichissez dans quelques minutes.')
 
 @app.route('/api/check_analysis_status')
 def check_analysis_status():
     """Vérifie si des données sont disponibles dans la table market_analysis"""
     if 'user_id' not in session: return jsonify({'error': 'Non autorisé'}), 401
     
-    conn = get_connection()
-    count = conn.execute('SELECT COUNT(*) as cnt FROM market_analysis').fetchone()['cnt']
-    last_updated = "Jamais"
-    if count > 0:
-        row = conn.execute('SELECT last_updated FROM market_analysis LIMIT 1').fetchone()
-        if row: last_updated = row['last_updated']
+    def build():
+        conn = get_connection()
+        count = conn.execute('SELECT COUNT(*) as cnt FROM market_analysis').fetchone()['cnt']
+        last_updated = "Jamais"
+        if count > 0:
+            row = conn.execute('SELECT last_updated FROM market_analysis LIMIT 1').fetchone()
+            if row: last_updated = row['last_updated']
+            
+        conn.close()
         
-    conn.close()
+        # On renvoie le nombre de résultats et la date de dernière mise à jour
+        # Le frontend pourra décider de rafraîchir la page si count > 0 et que c'était 0 avant
+        return jsonify({'count': count, 'last_updated': last_updated})
     
-    # On renvoie le nombre de résultats et la date de dernière mise à jour
-    # Le frontend pourra décider de rafraîchir la page si count > 0 et que c'était 0 avant
-    return jsonify({'count': count, 'last_updated': last_updated})
+    # 304 tant qu'aucun nouvel instantané n'a été publié
+    return conditional_json(['market_analysis'], build)
 
 @app.route('/debug_stellantis')
 def debug_stellantis():
@@ -1349,6 +3146,7 @@ def force_fix_stellantis():
         # Forcer prix_veille = prix_achat
         conn.execute('UPDATE actifs SET prix_veille = ? WHERE id = ?',
                    (stellantis['prix_achat'], stellantis['id']))
+        refresh_portfolio_summary(conn, session['user_id'])
         conn.commit()
         flash(f"✅ {stellantis['nom_actif']}: prix_veille forcé à {stellantis['prix_achat']}€", 'success')
     else:
@@ -1385,6 +3183,7 @@ def fix_today_purchases():
         fixed += 1
         print(f"DEBUG: Actif '{actif['nom_actif']}' acheté aujourd'hui, prix_veille = {actif['prix_achat']}")
     
+    refresh_portfolio_summary(conn, session['user_id'])
     conn.commit()
     conn.close()
     
@@ -1404,7 +3203,7 @@ def fix_prix_veille():
     conn = get_connection()
     
     # Forcer TOUS les prix_veille = prix_achat pour l'utilisateur
-    conn.execute('''UPDATE actifs 
+    cursor = conn.execute('''UPDATE actifs 
                     SET prix_veille = prix_achat 
                     WHERE id IN (
                         SELECT a.id FROM actifs a 
@@ -1412,7 +3211,8 @@ def fix_prix_veille():
                         WHERE c.user_id = ?
                     )''', (session['user_id'],))
     
-    rows_updated = conn.total_changes
+    rows_updated = cursor.rowcount
+    refresh_portfolio_summary(conn, session['user_id'])
     conn.commit()
     conn.close()
     
@@ -1428,30 +3228,10 @@ def reset_pv_mois():
     conn = get_connection()
     mois_actuel = datetime.now().strftime("%Y-%m")
     
-    # Récupérer tous les actifs de l'utilisateur
-    actifs = conn.execute('''SELECT a.id 
-                             FROM actifs a 
-                             JOIN comptes c ON a.compte_id = c.id 
-                             WHERE c.user_id = ?''', 
-                         (session['user_id'],)).fetchall()
-    
-    updated = 0
-    for actif in actifs:
-        # Mettre à jour ou créer l'enregistrement avec cumul = 0
-        existing = conn.execute(
-            'SELECT id FROM cumul_pv_mois WHERE actif_id = ? AND mois = ?',
-            (actif['id'], mois_actuel)
-        ).fetchone()
-        
-        if existing:
-            conn.execute('UPDATE cumul_pv_mois SET cumul_pv = 0, derniere_mise_a_jour = ? WHERE id = ?',
-                       (datetime.now().strftime("%Y-%m-%d"), existing['id']))
-        else:
-            conn.execute('INSERT INTO cumul_pv_mois (actif_id, mois, cumul_pv, derniere_mise_a_jour) VALUES (?, ?, 0, ?)',
-                       (actif['id'], mois_actuel, datetime.now().strftime("%Y-%m-%d")))
-        
-        updated += 1
+    # Une seule instruction pour tous les actifs de l'utilisateur
+    updated = open_month(conn, mois_actuel, session['user_id'])
     
+    refresh_portfolio_summary(conn, session['user_id'])
     conn.commit()
     conn.close()
     
@@ -1468,22 +3248,41 @@ def api_reset_month():
     
     conn = get_connection()
     mois_actuel = datetime.now().strftime("%Y-%m")
-    date_actuelle = datetime.now().strftime("%Y-%m-%d")
     
-    # Réinitialiser tous les cumuls du nouveau mois
-    # On supprime tous les enregistrements du mois actuel pour repartir à zéro
-    conn.execute('DELETE FROM cumul_pv_mois WHERE mois = ?', (mois_actuel,))
+    # Clôture du mois précédent (archivage du cumul) puis cumuls du nouveau mois à 0
+    result = rollover_month(conn, mois_actuel)
     
-    # Créer des enregistrements à 0 pour tous les actifs
-    actifs = conn.execute('SELECT id FROM actifs').fetchall()
-    for actif in actifs:
-        conn.execute('INSERT INTO cumul_pv_mois (actif_id, mois, cumul_pv, derniere_mise_a_jour) VALUES (?, ?, 0, ?)',
-                   (actif['id'], mois_actuel, date_actuelle))
+    refresh_all_portfolio_summaries(conn)
+    conn.commit()
+    conn.close()
+    
+    return jsonify({'success': True, 'message': f"Cumul mensuel réinitialisé pour {result['ouverts']} actifs", **result})
+
+@app.route('/api/recompute_cumul')
+def api_recompute_cumul():
+    """Recalcule le cumul d'un mois depuis l'historique des prix (token CRON : tous les utilisateurs)"""
+    if request.args.get('token') == CRON_TOKEN:
+        user_id = None
+    elif 'user_id' in session:
+        user_id = session['user_id']
+    else:
+        return jsonify({'error': 'Non autorise'}), 401
+    mois = request.args.get('mois') or datetime.now().strftime("%Y-%m")
+    if not re.match(r'^\d{4}-(0[1-9]|1[0-2])$', mois):
+        return jsonify({'error': 'Mois attendu au format AAAA-MM'}), 400
     
+    conn = get_connection()
+    recomputed = recompute_month_cumul(conn, mois, user_id)
+    if mois < datetime.now().strftime("%Y-%m"):
+        archive_month(conn, mois, user_id)
+    if user_id is None:
+        refresh_all_portfolio_summaries(conn)
+    else:
+        refresh_portfolio_summary(conn, user_id)
     conn.commit()
     conn.close()
     
-    return jsonify({'success': True, 'message': f'Cumul mensuel réinitialisé pour {len(actifs)} actifs'})
+    return jsonify({'success': True, 'mois': mois, 'recalcules': recomputed})
 
 @app.route('/api/stats_historique')
 def stats_historique():
@@ -1491,70 +3290,190 @@ def stats_historique():
     if 'user_id' not in session: 
         return jsonify({'error': 'Non connecte'})
     
-    conn = get_connection()
-    
-    # Nombre total d'enregistrements dans l'historique
-    total_records = conn.execute('''SELECT COUNT(*) as count FROM historique_prix h
-                                    JOIN actifs a ON h.actif_id = a.id
-                                    JOIN comptes c ON a.compte_id = c.id
-                                    WHERE c.user_id = ?''', 
-                                (session['user_id'],)).fetchone()['count']
-    
-    # Date du plus ancien enregistrement
-    oldest_record = conn.execute('''SELECT MIN(date) as oldest FROM historique_prix h
-                                    JOIN actifs a ON h.actif_id = a.id
-                                    JOIN comptes c ON a.compte_id = c.id
-                                    WHERE c.user_id = ?''', 
-                                (session['user_id'],)).fetchone()['oldest']
+    def build():
+        conn = get_connection()
     
-    # Nombre d'actifs avec historique
-    actifs_count = conn.execute('''SELECT COUNT(DISTINCT h.actif_id) as count 
-                                   FROM historique_prix h
-                                   JOIN actifs a ON h.actif_id = a.id
-                                   JOIN comptes c ON a.compte_id = c.id
-                                   WHERE c.user_id = ?''', 
-                               (session['user_id'],)).fetchone()['count']
+        # Nombre total d'enregistrements dans l'historique
+        total_records = conn.execute('''SELECT COUNT(*) as count FROM historique_prix h
+                                        JOIN actifs a ON h.actif_id = a.id
+                                        JOIN comptes c ON a.compte_id = c.id
+                                        WHERE c.user_id = ?''', 
+                                    (session['user_id'],)).fetchone()['count']
+    
+        # Date du plus ancien enregistrement
+        oldest_record = conn.execute('''SELECT MIN(date) as oldest FROM historique_prix h
+                                        JOIN actifs a ON h.actif_id = a.id
+                                        JOIN comptes c ON a.compte_id = c.id
+                                        WHERE c.user_id = ?''', 
+                                    (session['user_id'],)).fetchone()['oldest']
+    
+        # Nombre d'actifs avec historique
+        actifs_count = conn.execute('''SELECT COUNT(DISTINCT h.actif_id) as count 
+                                       FROM historique_prix h
+                                       JOIN actifs a ON h.actif_id = a.id
+                                       JOIN comptes c ON a.compte_id = c.id
+                                       WHERE c.user_id = ?''', 
+                                   (session['user_id'],)).fetchone()['count']
     
-    conn.close()
+        conn.close()
     
-    return jsonify({
-        'total_enregistrements': total_records,
-        'date_plus_ancien': oldest_record,
-        'nombre_actifs': actifs_count
-    })
+        return jsonify({
+            'total_enregistrements': total_records,
+            'date_plus_ancien': oldest_record,
+            'nombre_actifs': actifs_count
+        })
+
+    # Revalidation : 304 tant que l'historique de l'utilisateur n'a pas bougé
+    return conditional_json([f"user:{session['user_id']}"], build)
+
+@app.route('/api/portfolio_history')
+def api_portfolio_history():
+    """Valeur quotidienne du portefeuille (total et par compte) depuis l'historique matérialisé.
+
+    Paramètres optionnels : from / to (AAAA-MM-JJ), compte_id.
+    """
+    if 'user_id' not in session: 
+        return jsonify({'error': 'Non connecte'})
+    user_id = session['user_id']
+    date_from = request.args.get('from') or '0000-00-00'
+    date_to = request.args.get('to') or '9999-99-99'
+    compte_id = safe_int(request.args.get('compte_id'), 0)
+
+    def build():
+        conn = get_connection()
+        # Rattrapage si les positions ont changé depuis le dernier calcul (ajout, quantité...)
+        _, fingerprint = portfolio_positions(conn, user_id)
+        state = conn.execute('SELECT positions_hash FROM portfolio_history_state WHERE user_id = ?', (user_id,)).fetchone()
+        if not state or state['positions_hash'] != fingerprint:
+            refresh_portfolio_history(conn, user_id)
+            conn.commit()
+        comptes = {r['id']: r['nom_compte'] for r in conn.execute('SELECT id, nom_compte FROM comptes WHERE user_id = ?', (user_id,)).fetchall()}
+        rows = conn.execute('''SELECT compte_id, date, valeur FROM portfolio_history 
+                               WHERE user_id = ? AND date >= ? AND date <= ? AND (? = 0 OR compte_id = ?) 
+                               ORDER BY date''', (user_id, date_from, date_to, compte_id, compte_id)).fetchall()
+        conn.close()
+
+        dates = sorted({r['date'] for r in rows})
+        date_index = {d: i for i, d in enumerate(dates)}
+        par_compte = {}
+        total = [0.0] * len(dates)
+        for r in rows:
+            serie = par_compte.setdefault(r['compte_id'], {'nom': comptes.get(r['compte_id']), 'valeurs': [0.0] * len(dates)})
+            serie['valeurs'][date_index[r['date']]] = r['valeur']
+            total[date_index[r['date']]] += r['valeur']
+        return jsonify({'devise': 'EUR', 'dates': dates, 'total': [round(v, 2) for v in total],
+                        'comptes': par_compte})
+
+    return conditional_json([f"user:{user_id}"], build)
+
+# Regroupement des points d'historique par résolution (clé de bucket SQL)
+HISTORIQUE_RESOLUTIONS = {
+    'daily': "substr(date, 1, 10)",
+    'weekly': "date(substr(date, 1, 10), 'weekday 0', '-6 days')",  # lundi de la semaine
+    'monthly': "substr(date, 1, 7)",
+}
+HISTORIQUE_MAX_POINTS = 5000
+
+def downsample_lttb(points, target):
+    """Largest-Triangle-Three-Buckets : réduit une série [(x, y, ligne)] à `target` points
+    en gardant la forme visuelle (premier et dernier points conservés)"""
+    n = len(points)
+    if target >= n or target < 3:
+        return points
+    sampled = [points[0]]
+    bucket_size = (n - 2) / (target - 2)
+    a = 0
+    for i in range(target - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        # Moyenne du bucket suivant (troisième sommet du triangle)
+        next_start, next_end = end, min(int((i + 2) * bucket_size) + 1, n)
+        next_bucket = points[next_start:next_end] or [points[-1]]
+        avg_x = sum(p[0] for p in next_bucket) / len(next_bucket)
+        avg_y = sum(p[1] for p in next_bucket) / len(next_bucket)
+        ax, ay = points[a][0], points[a][1]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
 
 @app.route('/api/historique/<int:actif_id>')
 def get_historique(actif_id):
-    """Retourne l'historique des prix pour un actif donné"""
+    """Retourne l'historique des prix pour un actif donné.
+
+    Paramètres optionnels : from / to (AAAA-MM-JJ), resolution (daily, weekly,
+    monthly : dernier prix de chaque période), ohlc=1 (ouverture/plus haut/plus
+    bas par période) et points=N (sous-échantillonnage LTTB à N points).
+    """
     if 'user_id' not in session: 
         return jsonify({'error': 'Non connecte'})
     
+    resolution = request.args.get('resolution', 'daily')
+    if resolution not in HISTORIQUE_RESOLUTIONS:
+        return jsonify({'error': f"Résolution inconnue (valeurs : {', '.join(HISTORIQUE_RESOLUTIONS)})"}), 400
+    date_from = request.args.get('from') or '0000-00-00'
+    date_to = request.args.get('to') or '9999-99-99'
+    for value in (request.args.get('from'), request.args.get('to')):
+        if value and not re.match(r'^\d{4}-\d{2}-\d{2}$', value):
+            return jsonify({'error': 'Dates attendues au format AAAA-MM-JJ'}), 400
+    with_ohlc = request.args.get('ohlc') == '1'
+    target_points = safe_int(request.args.get('points'), 0)
+    
+    # Vérifier que l'actif appartient à l'utilisateur (avant toute revalidation 304)
     conn = get_connection()
-    
-    # Vérifier que l'actif appartient à l'utilisateur
     actif = conn.execute('''SELECT a.nom_actif FROM actifs a 
                             JOIN comptes c ON a.compte_id = c.id 
                             WHERE a.id = ? AND c.user_id = ?''', 
                          (actif_id, session['user_id'])).fetchone()
-    
+    conn.close()
     if not actif:
+        return jsonify({'error': 'Actif introuvable'}), 404
+    
+    def build():
+        conn = get_connection()
+    
+        # Agrégation côté SQL : une ligne par période (dernier prix, OHLC), via l'index (actif_id, date)
+        historique = conn.execute(f'''SELECT DISTINCT bucket, 
+                                            LAST_VALUE(date) OVER w AS date, 
+                                            LAST_VALUE(prix) OVER w AS prix, 
+                                            LAST_VALUE(devise) OVER w AS devise, 
+                                            FIRST_VALUE(prix) OVER w AS open, 
+                                            MAX(prix) OVER w AS high, 
+                                            MIN(prix) OVER w AS low 
+                                     FROM (SELECT date, prix, devise, {HISTORIQUE_RESOLUTIONS[resolution]} AS bucket 
+                                           FROM historique_prix 
+                                           WHERE actif_id = ? AND date >= ? AND date <= ? AND prix IS NOT NULL) 
+                                     WINDOW w AS (PARTITION BY bucket ORDER BY date 
+                                                  ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) 
+                                     ORDER BY date ASC''', 
+                                 (actif_id, date_from, date_to + '~')).fetchall()
+    
         conn.close()
-        return jsonify({'error': 'Actif introuvable'})
     
-    # Récupérer l'historique
-    historique = conn.execute('''SELECT date, prix, devise 
-                                 FROM historique_prix 
-                                 WHERE actif_id = ? 
-                                 ORDER BY date ASC''', 
-                             (actif_id,)).fetchall()
+        total = len(historique)
+        if target_points:
+            points = [(datetime.strptime(h['date'][:10], '%Y-%m-%d').toordinal(), h['prix'], h) for h in historique]
+            historique = [p[2] for p in downsample_lttb(points, min(max(target_points, 3), HISTORIQUE_MAX_POINTS))]
     
-    conn.close()
+        def serialize(h):
+            point = {'date': h['date'], 'prix': h['prix'], 'devise': h['devise']}
+            if with_ohlc:
+                point.update(open=h['open'], high=h['high'], low=h['low'], close=h['prix'])
+            return point
     
-    return jsonify({
-        'nom': actif['nom_actif'],
-        'historique': [{'date': h['date'], 'prix': h['prix'], 'devise': h['devise']} 
-                      for h in historique]
-    })
+        return jsonify({
+            'nom': actif['nom_actif'],
+            'resolution': resolution,
+            'points_total': total,
+            'historique': [serialize(h) for h in historique]
+        })
+
+    return conditional_json([f"actif:{actif_id}"], build)
 
 @app.route('/api/update_prices')
 def update_prices():
@@ -1572,84 +3491,79 @@ def update_prices():
     user_id_thread = session.get('user_id') if not is_cron else None
     
     # Définir la fonction de mise à jour (utilisée pour CRON et utilisateur)
-    def update_in_background():
+    def update_in_background(job):
             conn = get_connection()
-            # Si c'est un appel utilisateur, filtrer par user_id
-            if is_cron_thread:
-                actifs_db = conn.execute('''SELECT a.id, a.compte_id, UPPER(a.ticker_isin) as ticker, c.user_id 
-                                         FROM actifs a 
-                                         JOIN comptes c ON a.compte_id=c.id 
-                                         WHERE a.ticker_isin != ""''').fetchall()
-            else:
-                actifs_db = conn.execute('''SELECT a.id, a.compte_id, UPPER(a.ticker_isin) as ticker, c.user_id 
-                                         FROM actifs a 
-                                         JOIN comptes c ON a.compte_id=c.id 
-                                         WHERE c.user_id=? AND a.ticker_isin != ""''', (user_id_thread,)).fetchall()
-            
-            updated = 0
             date_actuelle = datetime.now().strftime("%Y-%m-%d")
             mois_actuel = datetime.now().strftime("%Y-%m")
             heure_actuelle = datetime.now().strftime("%d/%m %H:%M")
             
-            print(f"DEBUG: Debut mise a jour pour {len(actifs_db)} titres")
+            # Lecture unique des positions (prix, quantité) ; si c'est un appel utilisateur, filtrer par user_id
+            query = '''SELECT a.id, a.compte_id, UPPER(a.ticker_isin) as ticker, c.user_id, a.prix_actuel, a.quantite
+                       FROM actifs a 
+                       JOIN comptes c ON a.compte_id=c.id 
+                       WHERE a.ticker_isin != ""'''
+            if is_cron_thread:
+                actifs_db = conn.execute(query).fetchall()
+            else:
+                actifs_db = conn.execute(query + ' AND c.user_id=?', (user_id_thread,)).fetchall()
+            
+            # Une seule cotation par symbole distinct, partagée entre toutes les positions
+            quotes = build_quote_table((row['ticker'] for row in actifs_db),
+                                       on_progress=lambda done, total: job.update(processed=done, total=total))
+            print(f"DEBUG: Debut mise a jour pour {len(actifs_db)} titres ({len(quotes)} symboles distincts)")
+            
+            # Taux de change du jour : complétés une fois par jour, puis un facteur par devise
+            try:
+                refresh_fx_rates(conn)
+                conn.commit()
+            except Exception as e:
+                print(f"DEBUG fx: Erreur mise a jour des taux = {e}")
+            fx = get_fx_snapshot()
+            
+            # Calcul en mémoire, puis écriture groupée (executemany) dans une seule transaction
+            actifs_rows = []
+            historique_rows = []
+            cumul_rows = []
             for row in actifs_db:
-                actif_info = conn.execute(
-                    'SELECT prix_actuel, prix_veille, quantite, frais, devise_cotation FROM actifs WHERE id = ?',
-                    (row['id'],)
-                ).fetchone()
+                ancien_prix = safe_float(row['prix_actuel'])
+                quantite = safe_int(row['quantite'])
+                
+                p, n, pv, currency = quotes.get(quote_key(row['ticker']), (None, None, None, None))
+                if p is None:
+                    continue
                 
-                ancien_prix = safe_float(actif_info['prix_actuel'])
-                prix_veille_actuel = safe_float(actif_info['prix_veille'])
-                quantite = safe_int(actif_info['quantite'])
-                frais = safe_float(actif_info['frais'])
+                # Décider du prix de veille à utiliser
+                if is_cron_thread:
+                    # CRON : utiliser le previousClose de l'API (prix de fermeture d'hier)
+                    nouveau_prix_veille = float(pv)
+                else:
+                    # Mise à jour manuelle : garder l'ancien prix actuel comme référence
+                    # pour que la PV du jour reflète la variation depuis la dernière MAJ
+                    nouveau_prix_veille = ancien_prix if ancien_prix > 0 else float(pv)
                 
-                p, n, pv, currency = fetch_price_from_api(row['ticker'])
-                if p is not None:
-                    # Décider du prix de veille à utiliser
-                    if is_cron_thread:
-                        # CRON : utiliser le previousClose de l'API (prix de fermeture d'hier)
-                        nouveau_prix_veille = float(pv)
-                    else:
-                        # Mise à jour manuelle : garder l'ancien prix actuel comme référence
-                        # pour que la PV du jour reflète la variation depuis la dernière MAJ
-                        nouveau_prix_veille = ancien_prix if ancien_prix > 0 else float(pv)
-                    
-                    pv_jour = (float(p) - nouveau_prix_veille) * quantite
-                    pv_jour_eur = convert_currency(pv_jour, currency, 'EUR')
-                    
-                    if cumul_actif_thread:
-                        cumul_existant = conn.execute(
-                            'SELECT id, cumul_pv, derniere_mise_a_jour FROM cumul_pv_mois WHERE actif_id = ? AND mois = ?',
-                            (row['id'], mois_actuel)
-                        ).fetchone()
-                        
-                        if cumul_existant:
-                            derniere_maj = cumul_existant['derniere_mise_a_jour']
-                            if derniere_maj != date_actuelle:
-                                nouveau_cumul = cumul_existant['cumul_pv'] + pv_jour_eur
-                                conn.execute('UPDATE cumul_pv_mois SET cumul_pv = ?, derniere_mise_a_jour = ? WHERE id = ?',
-                                           (nouveau_cumul, date_actuelle, cumul_existant['id']))
-                        else:
-                            conn.execute('INSERT INTO cumul_pv_mois (actif_id, mois, cumul_pv, derniere_mise_a_jour) VALUES (?, ?, 0, ?)',
-                                       (row['id'], mois_actuel, date_actuelle))
-                    
-                    conn.execute('UPDATE actifs SET prix_actuel = ?, prix_veille = ?, devise_cotation = ? WHERE id = ?',
-                               (float(p), nouveau_prix_veille, currency, row['id']))
-                    
-                    existing = conn.execute(
-                        'SELECT id FROM historique_prix WHERE actif_id = ? AND date = ?',
-                        (row['id'], date_actuelle)
-                    ).fetchone()
-                    
-                    if existing:
-                        conn.execute('UPDATE historique_prix SET prix = ?, devise = ? WHERE id = ?',
-                                   (float(p), currency, existing['id']))
-                    else:
-                        conn.execute('INSERT INTO historique_prix (actif_id, date, prix, devise) VALUES (?, ?, ?, ?)',
-                                   (row['id'], date_actuelle, float(p), currency))
-                    
-                    updated += 1
-                    print(f"DEBUG: Mis a jour {row['ticker']} -> {p} {currency}")
+                pv_jour = (float(p) - nouveau_prix_veille) * quantite
+                pv_jour_eur = pv_jour * fx.to_eur_factor(currency)
+                
+                actifs_rows.append((float(p), nouveau_prix_veille, currency, row['id']))
+                historique_rows.append((row['id'], date_actuelle, float(p), currency))
+                if cumul_actif_thread:
+                    cumul_rows.append((row['id'], mois_actuel, date_actuelle, pv_jour_eur))
+                print(f"DEBUG: Mis a jour {row['ticker']} -> {p} {currency}")
+            
+            conn.executemany('UPDATE actifs SET prix_actuel = ?, prix_veille = ?, devise_cotation = ? WHERE id = ?',
+                             actifs_rows)
+            # Un prix par actif et par jour (UNIQUE(actif_id, date)) : le dernier relevé remplace le précédent
+            conn.executemany('''INSERT INTO historique_prix (actif_id, date, prix, devise) VALUES (?, ?, ?, ?)
+                                ON CONFLICT(actif_id, date) DO UPDATE SET prix = excluded.prix, devise = excluded.devise''',
+                             historique_rows)
+            # Cumul du mois : créé à 0, puis augmenté de la PV du jour une seule fois par jour
+            conn.executemany('''INSERT INTO cumul_pv_mois (actif_id, mois, cumul_pv, derniere_mise_a_jour) VALUES (?, ?, 0, ?)
+                                ON CONFLICT(actif_id, mois) DO UPDATE SET
+                                    cumul_pv = cumul_pv_mois.cumul_pv + ?,
+                                    derniere_mise_a_jour = excluded.derniere_mise_a_jour
+                                WHERE cumul_pv_mois.derniere_mise_a_jour IS NOT excluded.derniere_mise_a_jour''',
+                             cumul_rows)
+            updated = len(actifs_rows)
             
             # Mettre à jour le timestamp uniquement pour les utilisateurs concernés
             if is_cron_thread:
@@ -1659,17 +3573,32 @@ def update_prices():
                 conn.execute('UPDATE users SET derniere_maj = ? WHERE id = ?', 
                             (heure_actuelle, user_id_thread))
             
+            # Les cours sont publiés tout de suite : le verrou d'écriture n'est tenu que le temps des upserts
             conn.commit()
+            
+            # Résumés matérialisés et historique de valorisation (dernières dates seulement) :
+            # une courte transaction par utilisateur
+            for uid in sorted({row['user_id'] for row in actifs_db}):
+                refresh_portfolio_summary(conn, uid)
+                refresh_portfolio_history(conn, uid)
+                conn.commit()
             conn.close()
+            job.update(message=f"{updated} actifs mis a jour")
             print(f"DEBUG: Mise a jour terminee, {updated} actifs mis a jour")
     
-    # Lancer en arrière-plan pour TOUS les appels (CRON et utilisateur)
-    thread = threading.Thread(target=update_in_background)
-    thread.daemon = True
-    thread.start()
+    # Lancer en arrière-plan pour TOUS les appels (CRON et utilisateur) ; un second
+    # déclenchement pendant la même mise à jour se rattache au job en cours. Le mode
+    # cumul fait partie de la clé : un appel ?cumul=true ne se rattache jamais à un
+    # rafraîchissement simple (la PV du jour ne serait pas ajoutée au cumul du mois)
+    if is_cron:
+        job_key = 'update_prices:all:cumul' if cumul_actif else 'update_prices:all'
+    else:
+        job_key = f'update_prices:user:{user_id_thread}'
+    job, attached = JOBS.submit('update_prices', job_key, update_in_background,
+                                priority='cron' if is_cron_thread else 'user')
     
     # Répondre immédiatement
-    return jsonify({'success': True, 'message': 'Mise a jour demarree en arriere-plan'})
+    return job_response(job, attached, 'Mise a jour demarree en arriere-plan')
 
 # --- ROUTE ETF ---
 @app.route('/conseil-etf')
@@ -1696,49 +3625,207 @@ def update_etf_analysis():
     """Mise à jour spécifique pour les ETF"""
     if 'user_id' not in session: return jsonify({'error': 'Non autorisé'}), 401
 
-    def run_update_etf():
-        conn = get_connection()
+    def run_update_etf(job):
         API_KEY = EODHD_API_KEY
-        BASE_URL = "https://eodhd.com/api/news"
-        REALTIME_API_URL = "https://eodhd.com/api/real-time"
+        BASE_URL = f"{EODHD_API_URL}/news"
+        REALTIME_API_URL = f"{EODHD_API_URL}/real-time"
         
         results_to_save = []
         # Pour les ETF, on utilise une logique différente : Tendance de prix (Trend)
         # On ne cherche pas de news, mais l'historique EOD
+        np = lazy_import('numpy')
+        
+        def sync_symbol(ticker):
+            conn = get_connection()
+            try:
+                sync_eod_candles(conn, ticker, API_KEY, bootstrap_days=ETF_LOOKBACK_DAYS)
+                conn.commit()
+            finally:
+                conn.close()
+        
+        # Sans NumPy : analyse ticker par ticker (tendance seule)
+        worker = sync_symbol if np else (lambda t: analyze_etf_trend(t, API_KEY, REALTIME_API_URL, ETF_NAMES_MAP))
         
+        if not EODHD.ledger.allows(len(ETF_TICKERS)):
+            job.update(message="Quota EODHD insuffisant : analyse reportée")
+            print("DEBUG quota: Analyse ETF reportée (quota EODHD réservé aux cotations)")
+            return
+        job.update(processed=0, total=len(ETF_TICKERS))
         with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
             future_to_ticker = {}
             for t in ETF_TICKERS:
-                future_to_ticker[executor.submit(analyze_etf_trend, t, API_KEY, REALTIME_API_URL, ETF_NAMES_MAP)] = t
+                future_to_ticker[executor.submit(with_priority(worker), t)] = t
             
             for future in concurrent.futures.as_completed(future_to_ticker):
                 try:
                     res = future.result()
                     if res: results_to_save.append(res)
-                except Exception as e: print(f"Erreur ETF: {e}")
+                except Exception as e: print(f"Erreur ETF {future_to_ticker[future]}: {e}")
+                job.update(processed=job.processed + 1)
         
         now = datetime.now().strftime('%d/%m/%Y à %H:%M')
         conn = get_connection()
-        conn.execute('DELETE FROM etf_analysis')
-        for r in results_to_save:
-            conn.execute('''INSERT INTO etf_analysis (ticker, name, score, nb_news, signal, signal_class, price, last_updated, expense_ratio, category, day_change_pct, trend_15d_pct)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                         (r['ticker'], r['name'], r['score'], r['nb_news'], r['signal'], r['signal_class'], r['price'], now, r.get('expense_ratio', 'N/A'), r.get('category', 'ETF'), r.get('day_change_pct', 0), r.get('trend_15d_pct', 0)))
-        conn.commit()
+        if np:
+            # Tous les indicateurs de l'univers en une passe sur la matrice des clôtures
+            results_to_save = analyze_etf_universe(np, conn, ETF_TICKERS, ETF_NAMES_MAP)
+        staging = open_staging(conn, 'etf_analysis')
+        conn.executemany(f'''INSERT INTO {staging} (ticker, name, score, nb_news, signal, signal_class, price, last_updated, expense_ratio, category, day_change_pct, trend_15d_pct,
+                                                     sma_20, sma_50, volatility_pct, max_drawdown_pct, momentum_pct)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                         [(r['ticker'], r['name'], r['score'], r['nb_news'], r['signal'], r['signal_class'], r['price'], now, r.get('expense_ratio', 'N/A'), r.get('category', 'ETF'), r.get('day_change_pct', 0), r.get('trend_15d_pct', 0),
+                           r.get('sma_20'), r.get('sma_50'), r.get('volatility_pct'), r.get('max_drawdown_pct'), r.get('momentum_pct'))
+                          for r in results_to_save])
+        publish_staged(conn, 'etf_analysis')
         conn.close()
+        job.update(message=f"{len(results_to_save)} ETF analysés")
 
-    thread = threading.Thread(target=run_update_etf)
-    thread.daemon = True
-    thread.start()
-    return jsonify({'success': True, 'message': 'Analyse ETF lancée'})
+    job, attached = JOBS.submit('etf_analysis', 'etf_analysis', run_update_etf, priority='analysis')
+    return job_response(job, attached, 'Analyse ETF lancée')
 
 @app.route('/api/check_etf_status')
 def check_etf_status():
     if 'user_id' not in session: return jsonify({'error': 'Non autorisé'}), 401
+
+    def build():
+        conn = get_connection()
+        count = conn.execute('SELECT COUNT(*) as cnt FROM etf_analysis').fetchone()['cnt']
+        conn.close()
+        return jsonify({'count': count})
+
+    return conditional_json(['etf_analysis'], build)
+
+@app.route('/api/provider_usage')
+def api_provider_usage():
+    """Consommation des fournisseurs : jour en cours (budgets par priorité) et historique"""
+    if 'user_id' not in session and request.args.get('token') != CRON_TOKEN:
+        return jsonify({'error': 'Non autorisé'}), 401
+    for client in PROVIDERS.values():
+        client.ledger.flush()
+    days = min(max(safe_int(request.args.get('days'), 30), 1), 366)
     conn = get_connection()
-    count = conn.execute('SELECT COUNT(*) as cnt FROM etf_analysis').fetchone()['cnt']
+    history = conn.execute('SELECT provider, day, calls FROM provider_usage ORDER BY day DESC, provider LIMIT ?',
+                           (days * len(PROVIDERS),)).fetchall()
     conn.close()
-    return jsonify({'count': count})
+    return jsonify({'providers': [client.status() for client in PROVIDERS.values()],
+                    'reserves': QUOTA_RESERVES,
+                    'history': [dict(r) for r in history]})
+
+@app.route('/api/fx_rates')
+def api_fx_rates():
+    """Taux de change en vigueur (instantané du jour) et historique récent (?days=)"""
+    if 'user_id' not in session and request.args.get('token') != CRON_TOKEN:
+        return jsonify({'error': 'Non autorisé'}), 401
+    days = min(max(safe_int(request.args.get('days'), 30), 1), 3660)
+    since = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    snapshot = get_fx_snapshot()
+    conn = get_connection()
+    history = conn.execute('SELECT devise, date, rate, stale FROM fx_rates WHERE date >= ? ORDER BY devise, date',
+                           (since,)).fetchall()
+    conn.close()
+    return jsonify({'date': snapshot.day, 'rates': snapshot.rates, 'stale': sorted(snapshot.stale),
+                    'history': [dict(r) for r in history]})
+
+@app.route('/api/jobs')
+def api_jobs():
+    """Jobs de fond actifs dans ce processus et historique récent (table jobs)"""
+    if 'user_id' not in session and request.args.get('token') != CRON_TOKEN:
+        return jsonify({'error': 'Non autorisé'}), 401
+    limit = min(max(safe_int(request.args.get('limit'), 20), 1), 200)
+    conn = get_connection()
+    recent = conn.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+    conn.close()
+    return jsonify({'max_concurrent': JOB_MAX_CONCURRENT,
+                    'active': [job.to_dict() for job in JOBS.list_active()],
+                    'recent': [dict(r) for r in recent]})
+
+# Flux de progression courts : chaque connexion occupe un thread gunicorn (--threads 8).
+# Le flux se ferme après JOB_STREAM_WINDOW secondes et le navigateur se reconnecte
+# (champ retry:) ; au-delà de JOB_STREAM_MAX flux simultanés, la connexion est refermée
+# aussitôt avec le même délai de reconnexion, pour laisser des threads aux autres requêtes.
+JOB_STREAM_WINDOW = safe_int(os.environ.get('JOB_STREAM_WINDOW'), 20)
+JOB_STREAM_MAX = max(1, safe_int(os.environ.get('JOB_STREAM_MAX'), 3))
+JOB_STREAM_RETRY_MS = safe_int(os.environ.get('JOB_STREAM_RETRY_MS'), 3000)
+# Sans job actif, la page reste à l'écoute (job lancé par le CRON) avec un délai plus long
+JOB_STREAM_IDLE_RETRY_MS = safe_int(os.environ.get('JOB_STREAM_IDLE_RETRY_MS'), 15000)
+job_stream_slots = threading.BoundedSemaphore(JOB_STREAM_MAX)
+
+def sse_event(event, data):
+    """Formate un évènement Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/job_events/<job_type>')
+def job_events(job_type):
+    """Flux SSE de progression d'un job (remplace le polling des pages).
+
+    Évènements : progress (processed/total), done (fin du job) et idle (aucun
+    job actif : dernier job connu). Sans fin de job, le flux se termine après
+    JOB_STREAM_WINDOW secondes et EventSource se reconnecte tout seul ; après
+    idle, la reconnexion attend JOB_STREAM_IDLE_RETRY_MS.
+    """
+    if 'user_id' not in session: return jsonify({'error': 'Non autorisé'}), 401
+    if job_type == 'update_prices':
+        key = f"update_prices:user:{session['user_id']}"
+    elif job_type in ('market_analysis', 'etf_analysis'):
+        key = job_type
+    else:
+        return jsonify({'error': 'Type de job inconnu'}), 404
+
+    def stream():
+        job = JOBS.get(key)
+        if job is None:
+            yield f'retry: {JOB_STREAM_IDLE_RETRY_MS}\n\n'
+            conn = get_connection()
+            last_job = conn.execute('SELECT * FROM jobs WHERE job_key = ? ORDER BY id DESC LIMIT 1', (key,)).fetchone()
+            conn.close()
+            yield sse_event('idle', dict(last_job) if last_job else {})
+            return
+        yield f'retry: {JOB_STREAM_RETRY_MS}\n\n'
+        # Trop de flux ouverts : fin immédiate, le navigateur réessaiera après retry
+        if not job_stream_slots.acquire(blocking=False):
+            return
+        try:
+            deadline = time.monotonic() + JOB_STREAM_WINDOW
+            last_sent = None
+            while time.monotonic() < deadline:
+                snapshot = job.to_dict()
+                state = (snapshot['state'], snapshot['processed'], snapshot['total'])
+                if state != last_sent:
+                    yield sse_event('progress', snapshot)
+                    last_sent = state
+                if job.done.wait(1.0):
+                    yield sse_event('done', job.to_dict())
+                    return
+        finally:
+            job_stream_slots.release()
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.after_request
+def record_first_response(response):
+    """Mesure le temps entre le chargement du module et la première réponse servie"""
+    if 'first_response_ms' not in STARTUP_TIMINGS:
+        elapsed = round((time.perf_counter() - STARTUP_T0) * 1000, 1)
+        STARTUP_TIMINGS['first_response_ms'] = elapsed
+        STARTUP_TIMINGS['first_response_path'] = request.path
+        if STARTUP_PROFILE or elapsed > STARTUP_TARGET_MS:
+            status = 'OK' if elapsed <= STARTUP_TARGET_MS else 'DEPASSE'
+            print(f"DEBUG startup: Première réponse ({request.path}) en {elapsed} ms "
+                  f"(objectif {STARTUP_TARGET_MS} ms : {status})")
+    return response
+
+@app.route('/api/startup_profile')
+def api_startup_profile():
+    """Coût du démarrage de ce worker (imports, init_db, première réponse)"""
+    if request.args.get('token') != CRON_TOKEN:
+        return jsonify({'error': 'Non autorisé'}), 401
+    return jsonify({'pid': os.getpid(), 'target_ms': STARTUP_TARGET_MS, 'timings': STARTUP_TIMINGS})
+
+STARTUP_TIMINGS['module_load_ms'] = round((time.perf_counter() - STARTUP_T0) * 1000, 1)
+if STARTUP_PROFILE:
+    print(f"DEBUG startup: imports {STARTUP_TIMINGS['imports_ms']} ms, "
+          f"init_db {STARTUP_TIMINGS['init_db_ms']} ms, "
+          f"chargement total {STARTUP_TIMINGS['module_load_ms']} ms")
 
 # Point d'entrée pour cPanel et Local
 application = app
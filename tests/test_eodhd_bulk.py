@@ -0,0 +1,115 @@
+"""Cotations groupées EODHD contre un serveur de remplacement local.
+
+Le serveur imite eod-bulk-last-day et real-time (mono et multi-symboles) ;
+EODHD_API_URL et la base sont redirigés avant l'import de l'application.
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+EOD_DATE = '2026-10-16'
+CALLS = []
+
+
+def stand_in_price(symbol):
+    return 10.0 + sum(map(ord, symbol)) % 50
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Réponses EODHD minimales ; les symboles LONE.* ne sont cotés qu'à l'unité"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        parts = url.path.split('/')
+        endpoint = parts[2]
+        if endpoint == 'eod-bulk-last-day':
+            exchange = parts[3]
+            codes = [c for c in query.get('symbols', [''])[0].split(',') if c]
+            CALLS.append((endpoint, exchange, len(codes)))
+            body = [{'code': c, 'exchange_short_name': exchange, 'date': EOD_DATE,
+                     'close': stand_in_price(f'{c}.{exchange}'), 'prev_close': stand_in_price(f'{c}.{exchange}') - 1}
+                    for c in codes if not c.startswith('LONE')]
+        elif endpoint == 'real-time' and 's' in query:
+            symbols = [parts[3]] + [s for s in query['s'][0].split(',') if s]
+            CALLS.append(('real-time-batch', None, len(symbols)))
+            body = [{'code': s, 'close': stand_in_price(s) + 0.5, 'previousClose': stand_in_price(s)}
+                    for s in symbols if not s.startswith('LONE')]
+        elif endpoint == 'real-time':
+            CALLS.append(('real-time', parts[3], 1))
+            body = {'code': parts[3], 'close': stand_in_price(parts[3]) + 0.25, 'previousClose': stand_in_price(parts[3])}
+        else:
+            CALLS.append((endpoint, None, 0))
+            body = []
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(data)
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+db_dir = tempfile.mkdtemp()
+os.environ['EODHD_API_URL'] = f'http://127.0.0.1:{server.server_address[1]}/api'
+os.environ['MONPECULE_DB_PATH'] = os.path.join(db_dir, 'monpecule.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+class BulkQuotesTest(unittest.TestCase):
+    PARIS = ['AI.PA', 'BNP.PA', 'OR.PA', 'LONE.PA']
+
+    def setUp(self):
+        CALLS.clear()
+        self.saved = (app.expected_eod_date, app.EODHD_BULK_MIN_SYMBOLS)
+        # Résolution en cache : le repli unitaire ne passe pas par la recherche Yahoo
+        app.save_resolution('LONE.PA', 'LONE.PA', 'Lone')
+
+    def tearDown(self):
+        app.expected_eod_date, app.EODHD_BULK_MIN_SYMBOLS = self.saved
+
+    def endpoints(self):
+        return Counter(endpoint for endpoint, _, _ in CALLS)
+
+    def test_bulk_then_batch_then_single_symbol(self):
+        app.expected_eod_date = lambda now=None: EOD_DATE
+        app.EODHD_BULK_MIN_SYMBOLS = 3
+        quotes = app.build_quote_table(self.PARIS + ['SOLB.BR'])
+
+        # Bulk pour Paris seulement (Bruxelles sous le seuil), real-time groupé pour le reste
+        self.assertIn(('eod-bulk-last-day', 'PA', 4), CALLS)
+        self.assertNotIn('BR', [exchange for endpoint, exchange, _ in CALLS if endpoint == 'eod-bulk-last-day'])
+        self.assertIn(('real-time-batch', None, 2), CALLS)
+        self.assertIn(('real-time', 'LONE.PA', 1), CALLS)
+        self.assertEqual(quotes['AI.PA'][0], stand_in_price('AI.PA'))
+        self.assertEqual(quotes['SOLB.BR'][0], stand_in_price('SOLB.BR') + 0.5)
+        self.assertEqual(quotes['LONE.PA'][0], stand_in_price('LONE.PA') + 0.25)
+
+    def test_small_portfolio_skips_bulk(self):
+        app.expected_eod_date = lambda now=None: EOD_DATE
+        quotes = app.build_quote_table(['BNP.PA', 'OR.PA'])
+
+        self.assertEqual(self.endpoints(), Counter({'real-time-batch': 1}))
+        self.assertEqual(quotes['BNP.PA'][2], stand_in_price('BNP.PA'))
+
+    def test_market_hours_use_realtime_only(self):
+        app.expected_eod_date = lambda now=None: None
+        app.EODHD_BULK_MIN_SYMBOLS = 1
+        quotes = app.build_quote_table(self.PARIS)
+
+        self.assertEqual(self.endpoints(), Counter({'real-time-batch': 1, 'real-time': 1}))
+        self.assertEqual(len([q for q in quotes.values() if q[0] is not None]), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
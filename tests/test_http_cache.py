@@ -0,0 +1,45 @@
+"""Réponses conditionnelles : ETag / Last-Modified sur les succès seulement, pour
+qu'une erreur ne puisse pas être revalidée en 304."""
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+os.environ.setdefault('MONPECULE_DB_PATH', os.path.join(tempfile.mkdtemp(), 'monpecule.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+class ConditionalJsonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.app.test_client()
+        email = f'etag-{time.time_ns()}@test'
+        self.client.post('/register', data={'nom': 'etag', 'email': email, 'password': 'x'})
+        conn = app.get_connection()
+        user_id = conn.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()['id']
+        compte_id = conn.execute('SELECT id FROM comptes WHERE user_id = ?', (user_id,)).fetchone()['id']
+        self.actif_id = conn.execute('''INSERT INTO actifs (compte_id, nom_actif, ticker_isin, quantite, prix_achat,
+                                        prix_actuel, frais) VALUES (?, 'Test', 'TST.PA', 1, 8, 10, 0)''',
+                                     (compte_id,)).lastrowid
+        conn.commit()
+        conn.close()
+
+    def test_success_is_revalidated(self):
+        first = self.client.get(f'/api/historique/{self.actif_id}')
+        self.assertEqual(first.status_code, 200)
+        self.assertIsNotNone(first.headers.get('ETag'))
+
+        second = self.client.get(f'/api/historique/{self.actif_id}', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(second.status_code, 304)
+
+    def test_error_has_no_validators(self):
+        missing = self.client.get('/api/historique/999999')
+        self.assertEqual(missing.status_code, 404)
+        self.assertIsNone(missing.headers.get('ETag'))
+        self.assertIsNone(missing.headers.get('Last-Modified'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+"""Disjoncteur des fournisseurs : une fois le délai écoulé, un seul appel d'essai
+passe (demi-ouvert) jusqu'à son verdict."""
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+os.environ.setdefault('MONPECULE_DB_PATH', os.path.join(tempfile.mkdtemp(), 'monpecule.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+def from_other_thread(fn):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(fn()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+class HalfOpenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.ProviderClient('test', rate=100, timeout=1, failure_threshold=1, cooldown=0)
+        self.client.record_failure()
+
+    def test_single_probe_until_success(self):
+        self.assertFalse(self.client.is_open())
+        self.assertTrue(from_other_thread(self.client.is_open))
+        self.client.record_success()
+        self.assertFalse(from_other_thread(self.client.is_open))
+
+    def test_failed_probe_reopens(self):
+        self.assertFalse(self.client.is_open())
+        self.client.record_failure()
+        self.assertIsNotNone(self.client.opened_at)
+        # Délai nul : le thread suivant devient le nouvel appel d'essai
+        self.assertFalse(from_other_thread(self.client.is_open))
+        self.assertTrue(self.client.is_open())
+
+    def test_probe_refused_by_quota_is_released(self):
+        def refuse(cost=1, priority=None):
+            raise app.QuotaExceededError('quota')
+        self.client.ledger.reserve = refuse
+        with self.assertRaises(app.QuotaExceededError):
+            self.client.get('http://127.0.0.1:9/')
+        self.assertFalse(from_other_thread(self.client.is_open))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Cache négatif des identifiants : seules les réponses « sans cours » des deux
+fournisseurs le déclenchent, pas les erreurs réseau."""
+import os
+import sys
+import tempfile
+import unittest
+
+import requests
+
+os.environ.setdefault('MONPECULE_DB_PATH', os.path.join(tempfile.mkdtemp(), 'monpecule.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def answer(status_code, data):
+    return lambda url, params=None, **kwargs: FakeResponse(status_code, data)
+
+
+def fail(error):
+    def get(url, params=None, **kwargs):
+        raise error
+    return get
+
+
+class QuoteLookupTest(unittest.TestCase):
+    IDENTIFIER = 'NOQUOTE1'
+
+    def setUp(self):
+        self.saved = (app.EODHD.get, app.YAHOO.get)
+        # Résolution en cache : seule la cotation passe par les fournisseurs simulés
+        app.save_resolution(self.IDENTIFIER, 'NOQUOTE1.PA', 'No quote')
+        app.clear_lookup_failure(self.IDENTIFIER)
+
+    def tearDown(self):
+        app.EODHD.get, app.YAHOO.get = self.saved
+        app.clear_lookup_failure(self.IDENTIFIER)
+
+    def test_both_providers_answer_empty(self):
+        app.EODHD.get = answer(200, {})
+        app.YAHOO.get = answer(404, {'chart': {'result': None}})
+
+        self.assertEqual(app.fetch_quote_for_symbol('NOQUOTE1.PA', 'x'), ((None, None, None, None), True))
+        app.fetch_price_from_api(self.IDENTIFIER, ignore_backoff=True)
+        self.assertIsNotNone(app.get_lookup_failure(self.IDENTIFIER))
+
+    def test_one_provider_errors(self):
+        app.EODHD.get = answer(200, {})
+        app.YAHOO.get = fail(requests.Timeout('slow'))
+        self.assertEqual(app.fetch_quote_for_symbol('NOQUOTE1.PA', 'x'), ((None, None, None, None), False))
+
+        app.EODHD.get = answer(502, {})
+        app.YAHOO.get = answer(200, {'chart': {'result': None}})
+        self.assertEqual(app.fetch_quote_for_symbol('NOQUOTE1.PA', 'x'), ((None, None, None, None), False))
+
+        app.fetch_price_from_api(self.IDENTIFIER, ignore_backoff=True)
+        self.assertIsNone(app.get_lookup_failure(self.IDENTIFIER))
+
+    def test_quote_found(self):
+        app.EODHD.get = answer(200, {'close': 12.5, 'previousClose': 12.0})
+        quote, no_data = app.fetch_quote_for_symbol('NOQUOTE1.PA', 'x')
+        self.assertEqual(quote[0], 12.5)
+        self.assertFalse(no_data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+"""Single-flight des mises à jour de prix : un appel CRON ?cumul=true pendant un
+rafraîchissement simple doit lancer son propre job et alimenter le cumul du mois."""
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+
+os.environ.setdefault('MONPECULE_DB_PATH', os.path.join(tempfile.mkdtemp(), 'monpecule.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+class OverlappingCronTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (app.build_quote_table, app.refresh_fx_rates)
+        self.release = threading.Event()
+        self.calls = 0
+
+        def slow_quotes(tickers, on_progress=None, **kwargs):
+            self.calls += 1
+            if self.calls == 1:
+                # Le premier job (rafraîchissement simple) reste actif pendant le second appel
+                self.release.wait(5)
+            return {app.quote_key(t): (12.0, t, 10.0, 'EUR') for t in tickers}
+
+        app.build_quote_table = slow_quotes
+        app.refresh_fx_rates = lambda conn: 0
+        self.client = app.app.test_client()
+        email = f'cron-{time.time_ns()}@test'
+        self.client.post('/register', data={'nom': 'cron', 'email': email, 'password': 'x'})
+        conn = app.get_connection()
+        user_id = conn.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()['id']
+        compte_id = conn.execute('SELECT id FROM comptes WHERE user_id = ?', (user_id,)).fetchone()['id']
+        self.actif_id = conn.execute('''INSERT INTO actifs (compte_id, nom_actif, ticker_isin, quantite, prix_achat,
+                                        prix_actuel, frais) VALUES (?, 'Test', 'TST.PA', 3, 8, 10, 0)''',
+                                     (compte_id,)).lastrowid
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.release.set()
+        for job in app.JOBS.list_active():
+            job.done.wait(5)
+        app.build_quote_table, app.refresh_fx_rates = self.saved
+
+    def test_cumul_call_does_not_attach_to_plain_refresh(self):
+        token = app.CRON_TOKEN
+        plain = self.client.get(f'/api/update_prices?token={token}').json
+        cumul = self.client.get(f'/api/update_prices?token={token}&cumul=true').json
+
+        self.assertFalse(plain['attached'])
+        self.assertFalse(cumul['attached'])
+        self.assertNotEqual(plain['job']['key'], cumul['job']['key'])
+
+        self.release.set()
+        for job in app.JOBS.list_active():
+            job.done.wait(5)
+        conn = app.get_connection()
+        row = conn.execute('SELECT cumul_pv, derniere_mise_a_jour FROM cumul_pv_mois WHERE actif_id = ? AND mois = ?',
+                           (self.actif_id, datetime.now().strftime('%Y-%m'))).fetchone()
+        conn.close()
+        self.assertIsNotNone(row)
+        self.assertEqual(row['derniere_mise_a_jour'], datetime.now().strftime('%Y-%m-%d'))
+
+    def test_second_plain_call_attaches(self):
+        token = app.CRON_TOKEN
+        first = self.client.get(f'/api/update_prices?token={token}').json
+        second = self.client.get(f'/api/update_prices?token={token}').json
+
+        self.assertFalse(first['attached'])
+        self.assertTrue(second['attached'])
+        self.assertEqual(first['job']['id'], second['job']['id'])
+
+
+if __name__ == '__main__':
+    unittest.main()